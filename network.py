@@ -1,38 +1,807 @@
 import sys
 import os
 import random
+import heapq
+import copy
+import itertools
+import math
+import socket
+import struct
 import threading
+import traceback
+from collections import deque
 from queue import Queue
+import time
+from time import monotonic
 
+# Values of the how argument to StreamSocket.shutdown
+SHUT_RD = 0
+SHUT_WR = 1
+SHUT_RDWR = 2
 
-def _trialgen(prob):
+def trials(prob, rng=None):
+    """
+    Returns an iterator over independent trials which each succeed with
+    probability prob
+
+    The trials are decided a block at a time and handed out from a list, so
+    that taking one costs no Python code.  The decisions come from rng,
+    which may be a random.Random (a fresh one by default) or a NumPy
+    Generator.
+    """
+    if prob <= 0:
+        return itertools.repeat(False)
+    if prob >= 1:
+        return itertools.repeat(True)
+    return itertools.chain.from_iterable(_trial_blocks(prob,
+                                                       rng or random.Random()))
+
+
+def _trial_blocks(prob, rng, size=4096):
+    """
+    Yields lists of size trial outcomes
+
+    Rare successes are placed by drawing the gaps between them from a
+    geometric distribution; otherwise each trial compares 32 random bits
+    against a threshold.
+    """
+    if hasattr(rng, 'bit_generator'):
+        while True:
+            yield (rng.random(size) < prob).tolist()
+    if prob >= 0.1:
+        threshold = round(prob * 2 ** 32)
+        while True:
+            bits = rng.getrandbits(32 * size).to_bytes(4 * size, 'little')
+            yield [x < threshold for x in memoryview(bits).cast('I')]
+    scale = 1 / math.log1p(-prob)
+    rand = rng.random
+    pos = int(math.log(1.0 - rand()) * scale)  # next success
     while True:
-        yield random.random() < prob
+        block = [False] * size
+        while pos < size:
+            block[pos] = True
+            pos += 1 + int(math.log(1.0 - rand()) * scale)
+        pos -= size
+        yield block
+
+
+def _substream(rng):
+    """Returns an independent generator seeded from rng"""
+    if hasattr(rng, 'spawn'):
+        return rng.spawn(1)[0]
+    return random.Random(rng.getrandbits(64))
+
+
+class ChannelModel:
+    """
+    Base class for models of what a link does to the packets crossing it
+
+    A network runs each packet through a list of models in turn, with its
+    trialmut held.  Models may keep state from one packet to the next, so an
+    instance should be used on one network only.  Random decisions come
+    from rng; a model without one is given a generator by the network.
+    """
+
+    def __init__(self, rng=None):
+        self.rng = rng
+
+    def bind(self, rng):
+        """Gives the model a random generator, unless it already has one"""
+        if self.rng is None:
+            self.rng = rng
+
+    def transmit(self, data):
+        """
+        Returns the packet as it arrives: data itself if untouched, a
+        changed copy, or None if it is lost
+        """
+        raise NotImplementedError
+
+
+class BernoulliLoss(ChannelModel):
+    """
+    Loses each packet independently with probability prob, or whenever an
+    iterator of trials given instead yields true
+    """
+
+    def __init__(self, prob, rng=None):
+        super().__init__(rng)
+        self.prob = prob
+        self.hits = prob if hasattr(prob, '__next__') else None
+
+    def bind(self, rng):
+        super().bind(rng)
+        if self.hits is None:
+            self.hits = trials(self.prob, self.rng)
+
+    def transmit(self, data):
+        return None if next(self.hits) else data
+
+
+class GilbertElliott(ChannelModel):
+    """
+    Bursty loss from a two-state Markov chain
+
+    Before each packet the channel moves from the good state to the bad one
+    with probability p, and back with probability r, so bursts last 1/r
+    packets on average.  Packets are lost with probability loss_good in the
+    good state and loss_bad in the bad one.
+    """
+
+    def __init__(self, p, r, loss_good=0.0, loss_bad=1.0, rng=None):
+        super().__init__(rng)
+        self.p = p
+        self.r = r
+        self.loss_good = loss_good
+        self.loss_bad = loss_bad
+        self.bad = False
+
+    def transmit(self, data):
+        rand = self.rng.random
+        if rand() < (self.r if self.bad else self.p):
+            self.bad = not self.bad
+        loss = self.loss_bad if self.bad else self.loss_good
+        return None if loss and rand() < loss else data
+
+
+class ByteCorruption(ChannelModel):
+    """
+    Corrupts each packet independently with probability prob, or whenever
+    an iterator of trials given instead yields true, by overwriting count
+    random bytes with random values
+    """
+
+    def __init__(self, prob, count=1, rng=None):
+        super().__init__(rng)
+        self.prob = prob
+        self.count = count
+        self.hits = prob if hasattr(prob, '__next__') else None
+
+    def bind(self, rng):
+        super().bind(rng)
+        if self.hits is None:
+            self.hits = trials(self.prob, self.rng)
+
+    def transmit(self, data):
+        if not next(self.hits) or not data:
+            return data
+        rand = self.rng.random
+        buf = bytearray(data)
+        for i in range(self.count):
+            buf[int(rand() * len(buf))] = int(rand() * 256)
+        return buf
+
+
+class BitErrors(ChannelModel):
+    """
+    Flips each bit independently with probability ber
+
+    The bits of successive packets form one stream, and only the distance
+    to the next error in it is drawn, so a packet without errors costs a
+    comparison.
+    """
+
+    def __init__(self, ber, rng=None):
+        super().__init__(rng)
+        self.ber = ber
+        self.until = None  # error-free bits before the next error
+
+    def gap(self):
+        if self.ber <= 0:
+            return math.inf
+        if self.ber >= 1:
+            return 0
+        return int(math.log(1.0 - self.rng.random()) / math.log1p(-self.ber))
+
+    def transmit(self, data):
+        if self.until is None:
+            self.until = self.gap()
+        bits = len(data) * 8
+        if self.until >= bits:
+            self.until -= bits
+            return data
+        buf = bytearray(data)
+        pos = self.until
+        while pos < bits:
+            buf[pos >> 3] ^= 0x80 >> (pos & 7)
+            pos += 1 + self.gap()
+        self.until = pos - bits
+        return buf
+
+
+class Truncation(ChannelModel):
+    """
+    Cuts each packet short, to a random length, with probability prob
+    """
+
+    def __init__(self, prob, rng=None):
+        super().__init__(rng)
+        self.prob = prob
+        self.hits = None
+
+    def bind(self, rng):
+        super().bind(rng)
+        self.hits = trials(self.prob, self.rng)
+
+    def transmit(self, data):
+        if not next(self.hits) or not data:
+            return data
+        return data[:int(self.rng.random() * len(data))]
+
+
+class QueueDiscipline:
+    """
+    Base class for policies deciding which packets a Bottleneck queues
+
+    A packet refused is dropped before it is transmitted.  As with
+    ChannelModels, an instance keeps state and belongs to one bottleneck,
+    and random decisions come from rng or a generator the network gives it.
+    """
+
+    def __init__(self, limit=100, rng=None):
+        self.limit = limit  # packets the queue can hold
+        self.rng = rng
+
+    def bind(self, rng):
+        """Gives the discipline a random generator, unless it has one"""
+        if self.rng is None:
+            self.rng = rng
+
+    def admit(self, now, backlog, wait):
+        """
+        Returns whether to queue a packet arriving at time now, with backlog
+        packets queued ahead of it and wait seconds before it would start
+        being transmitted
+        """
+        raise NotImplementedError
+
+
+class DropTail(QueueDiscipline):
+    """Queues every packet until the queue is full"""
+
+    def admit(self, now, backlog, wait):
+        return backlog < self.limit
+
+
+class RED(QueueDiscipline):
+    """
+    Random Early Detection: drops packets with a probability rising from 0
+    to max_p as the average queue length goes from min_th to max_th packets,
+    and every packet above that
+
+    The average is a moving one, taking weight of each new sample.
+    """
+
+    def __init__(self, limit=100, min_th=5, max_th=15, max_p=0.1,
+                 weight=0.002, rng=None):
+        super().__init__(limit, rng)
+        self.min_th = min_th
+        self.max_th = max_th
+        self.max_p = max_p
+        self.weight = weight
+        self.avg = 0.0
+        self.count = 0  # packets queued since the last drop
+
+    def admit(self, now, backlog, wait):
+        self.avg += self.weight * (backlog - self.avg)
+        if backlog >= self.limit or self.avg >= self.max_th:
+            self.count = 0
+            return False
+        if self.avg < self.min_th:
+            self.count = 0
+            return True
+        # Spread drops out evenly, rather than in clusters
+        prob = (self.max_p * (self.avg - self.min_th) /
+                (self.max_th - self.min_th))
+        if self.count * prob < 1 and \
+                self.rng.random() * (1 - self.count * prob) >= prob:
+            self.count += 1
+            return True
+        self.count = 0
+        return False
+
+
+class CoDel(QueueDiscipline):
+    """
+    Controlled Delay: once packets have been kept waiting longer than target
+    seconds for a whole interval, drops them at a rate growing with the
+    square root of the number dropped, until the wait falls back under
+    target
+
+    CoDel drops packets as they leave the queue; since a bottleneck knows
+    when each packet will leave as it arrives, the decision is taken then.
+    """
+
+    def __init__(self, limit=1000, target=0.005, interval=0.1, rng=None):
+        super().__init__(limit, rng)
+        self.target = target
+        self.interval = interval
+        self.first_above = None  # when the wait may first be judged too long
+        self.dropping = False
+        self.drop_next = 0.0
+        self.count = 0  # packets dropped since dropping started
+        self.last_count = 0
+
+    def admit(self, now, backlog, wait):
+        if backlog >= self.limit:
+            return False
+        leave = now + wait
+        if wait < self.target or backlog == 0:
+            self.first_above = None
+            self.dropping = False
+            return True
+        if self.first_above is None:
+            self.first_above = leave + self.interval
+            return True
+        if self.dropping:
+            if leave < self.drop_next:
+                return True
+            self.count += 1
+            self.drop_next += self.interval / math.sqrt(self.count)
+            return False
+        if leave < self.first_above:
+            return True
+        # Start dropping, at about the rate reached last time if that was
+        # recent
+        self.dropping = True
+        delta = self.count - self.last_count
+        if delta > 1 and leave - self.drop_next < 16 * self.interval:
+            self.count = delta
+        else:
+            self.count = 1
+        self.last_count = self.count
+        self.drop_next = leave + self.interval / math.sqrt(self.count)
+        return False
+
+
+class Bottleneck:
+    """
+    A transmitter sending packets one at a time at bandwidth bits per
+    second, from a queue managed by discipline (a DropTail by default)
+
+    Counts the packets and bytes it has sent, those dropped, the largest
+    backlog it has had and the total time packets spent queued.
+    """
+
+    def __init__(self, bandwidth, discipline=None):
+        self.bandwidth = bandwidth
+        self.discipline = discipline or DropTail()
+        self.busy = 0.0  # time when the last packet queued has been sent
+        self.departures = deque()  # times when queued packets are sent
+        self.packets = 0
+        self.bytes = 0
+        self.drops = 0
+        self.peak = 0
+        self.queue_delay = 0.0
+
+    def backlog(self, now):
+        """Returns the number of packets queued or being sent at time now"""
+        while self.departures and self.departures[0] <= now:
+            self.departures.popleft()
+        return len(self.departures)
+
+    def enqueue(self, now, size):
+        """
+        Queues a packet of size bytes at time now, returning the time until
+        it has been sent, or None if it is dropped
+        """
+        backlog = self.backlog(now)
+        wait = max(self.busy - now, 0.0)
+        if not self.discipline.admit(now, backlog, wait):
+            self.drops += 1
+            return None
+        self.busy = now + wait + size * 8 / self.bandwidth
+        self.departures.append(self.busy)
+        self.packets += 1
+        self.bytes += size
+        self.peak = max(self.peak, backlog + 1)
+        self.queue_delay += wait
+        return self.busy - now
 
 
 def _hexdump(data):
+    lines = []
     for ofs in range(0, len(data), 16):
         line = data[ofs:ofs+16]
         hex1 = ' '.join('%02x' % c for c in line[:8])
         hex2 = ' '.join('%02x' % c for c in line[8:])
         disp = ''.join(chr(c) if c in range(32, 128) else '.' for c in line)
-        print('%08x  %-23s  %-23s  |%s|' % (ofs, hex1, hex2, disp),
-              file=sys.stderr)
-    print('%08x' % (len(data),), file=sys.stderr)
+        lines.append('%08x  %-23s  %-23s  |%s|' % (ofs, hex1, hex2, disp))
+    lines.append('%08x' % (len(data),))
+    print('\n'.join(lines), file=sys.stderr)
+
+
+class Capture:
+    """
+    Records the packets a network transmits to a pcapng file
+
+    Each packet is written as a raw IPv4 packet, behind a header built from
+    its source and destination addresses and protocol ID, and timestamped
+    by the network's clock.  Packets dropped from a full queue, lost in
+    transit or corrupted carry a comment saying so; a corrupted packet is
+    recorded as it arrived.
+
+    Records are kept in memory and written out once bufsize bytes have built
+    up, and on flush() or close().  With ring set, only the last ring
+    packets are kept, and nothing is written until then.  If given,
+    filter(src, dst, proto, data) decides which packets are recorded.
+    Packets are cut to snaplen bytes.
+    """
+
+    LINKTYPE_RAW = 101
+    COMMENTS = {'lost': b'lost', 'corrupted': b'corrupted',
+                'dropped': b'dropped'}
+
+    def __init__(self, path, ring=None, filter=None, snaplen=65535,
+                 bufsize=1 << 20):
+        self.file = open(path, 'wb')
+        self.filter = filter
+        self.snaplen = snaplen
+        self.bufsize = bufsize
+        self.records = deque(maxlen=ring)
+        self.size = 0  # bytes in records
+        self.addrs = {}  # address -> 4 bytes for the IPv4 header
+        self.mut = threading.Lock()
+        self.epoch = None  # wall-clock time of clock time 0
+        # Section header and interface description, with timestamps in
+        # nanoseconds
+        self.file.write(struct.pack('<IIIHHq', 0x0A0D0D0A, 28, 0x1A2B3C4D,
+                                    1, 0, -1) + struct.pack('<I', 28))
+        self.file.write(struct.pack('<IIHHIHHBxxxHHI', 1, 32,
+                                    self.LINKTYPE_RAW, 0, snaplen,
+                                    9, 1, 9, 0, 0, 32))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def address(self, addr):
+        packed = self.addrs.get(addr)
+        if packed is None:
+            # Hosts not named by a dotted quad appear as 0.0.0.0
+            try:
+                packed = socket.inet_aton(addr)
+            except (OSError, TypeError):
+                packed = bytes(4)
+            self.addrs[addr] = packed
+        return packed
+
+    def record(self, now, src, dst, proto, data, marker=None):
+        """
+        Records a packet transmitted at clock time now; marker is None,
+        'dropped', 'lost' or 'corrupted'
+        """
+        if self.filter is not None and not self.filter(src, dst, proto, data):
+            return
+        if self.epoch is None:
+            self.epoch = time.time() - now
+        # IPv4 header; the checksum is left out, as in captures taken with
+        # checksum offloading
+        length = 20 + len(data)
+        packet = struct.pack('!BBHHHBBH4s4s', 0x45, 0, min(length, 0xffff),
+                             0, 0, 64, proto & 0xff, 0, self.address(src),
+                             self.address(dst)) + bytes(data[:self.snaplen-20])
+        pad = -len(packet) % 4
+        options = b''
+        if marker is not None:
+            comment = self.COMMENTS[marker]
+            options = (struct.pack('<HH', 1, len(comment)) + comment +
+                       bytes(-len(comment) % 4) + bytes(4))
+        total = 32 + len(packet) + pad + len(options)
+        ts = round((self.epoch + now) * 1e9)
+        block = b''.join((struct.pack('<IIIIIII', 6, total, 0, ts >> 32,
+                                      ts & 0xffffffff, len(packet), length),
+                          packet, bytes(pad), options,
+                          struct.pack('<I', total)))
+        with self.mut:
+            if len(self.records) == self.records.maxlen:
+                self.size -= len(self.records[0])
+            self.records.append(block)
+            self.size += len(block)
+            if self.records.maxlen is None and self.size >= self.bufsize:
+                self.write()
+
+    def write(self):
+        """Writes out the records held; the caller must hold mut"""
+        self.file.write(b''.join(self.records))
+        self.records.clear()
+        self.size = 0
+
+    def flush(self):
+        """Writes out every record held so far"""
+        with self.mut:
+            self.write()
+            self.file.flush()
+
+    def close(self):
+        with self.mut:
+            if self.file.closed:
+                return
+            self.write()
+            self.file.close()
+
+
+class Clock:
+    """
+    Wall-clock time, and timed waits on condition variables measured by it
+
+    Code which should also run in simulated time takes the time, waits and
+    notifies through a clock rather than calling the time module and the
+    condition variables directly.
+    """
+
+    def monotonic(self):
+        """Returns the current time in seconds"""
+        return monotonic()
+
+    def wait(self, cond, timeout=None):
+        """
+        Waits on a condition variable, whose lock the caller holds, until it
+        is notified or timeout seconds pass; returns False on timeout
+
+        Like Condition.wait, this may also return early for no reason.
+        """
+        return cond.wait(timeout)
+
+    def wait_for(self, cond, predicate, timeout=None):
+        """
+        Waits on a condition variable until predicate() is true or timeout
+        seconds pass, returning the last value of predicate()
+        """
+        end = None if timeout is None else self.monotonic() + timeout
+        result = predicate()
+        while not result:
+            remaining = None
+            if end is not None:
+                remaining = end - self.monotonic()
+                if remaining <= 0:
+                    break
+            self.wait(cond, remaining)
+            result = predicate()
+        return result
+
+    def notify(self, cond):
+        """Wakes one thread waiting on a condition variable"""
+        cond.notify()
+
+    def notify_all(self, cond):
+        """Wakes every thread waiting on a condition variable"""
+        cond.notify_all()
+
+    def start_thread(self, target, *args):
+        """Starts a daemon thread running target(*args) and returns it"""
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        return thread
+
+
+class VirtualClock(Clock):
+    """
+    Simulated time, which stands still while the network has work to do and
+    jumps straight to the next deadline once it has none
+
+    Threads started through the clock (the scheduler, host workers and
+    protocol threads) are busy whenever they are not waiting on it, and any
+    thread is busy from being notified through the clock until it wakes.
+    Other threads, such as the application's, do not otherwise hold time up,
+    so a thread joining another one does not stop the clock.  Time therefore
+    depends only on what the threads do, not on how fast the host runs
+    them, and a clock thread blocked outside the clock (on a plain lock or
+    queue) stops time until it is released.  Given grace, time moves on
+    anyway once nothing has happened for grace real seconds; that avoids
+    such stalls, but then a loaded host can make timers fire early in
+    simulated terms, and runs are no longer reproducible.  Waiting threads
+    look at the clock every POLL real seconds, in case a deadline passed
+    without a lock being free to wake them.
+
+    Time is kept in whole nanoseconds, and deadlines are rounded up, so that
+    a thread woken at a deadline computed from an earlier reading finds that
+    deadline passed despite floating-point rounding.
+    """
+
+    POLL = 0.005
+
+    def __init__(self, start=0.0, grace=None):
+        self.now = round(start * 1e9)  # nanoseconds
+        self.grace = grace
+        self.mut = threading.Lock()
+        # thread -> [condition, deadline or None, notified]
+        self.waiting = {}
+        self.threads = set()  # threads started through the clock
+        self.activity = monotonic()  # real time of the last wait or notify
+
+    def monotonic(self):
+        return self.now / 1e9
+
+    def wait(self, cond, timeout=None):
+        me = threading.current_thread()
+        with self.mut:
+            deadline = None
+            if timeout is not None:
+                deadline = self.now + max(0, math.ceil(timeout * 1e9))
+            entry = self.waiting[me] = [cond, deadline, False]
+            self.activity = monotonic()
+        try:
+            while True:
+                with self.mut:
+                    if entry[2]:
+                        return True
+                    self.advance()
+                    if deadline is not None and self.now >= deadline:
+                        return False
+                if cond.wait(self.POLL):
+                    return True
+        finally:
+            with self.mut:
+                del self.waiting[me]
+                self.activity = monotonic()
+
+    def notify(self, cond):
+        with self.mut:
+            for entry in self.waiting.values():
+                if entry[0] is cond and not entry[2]:
+                    entry[2] = True
+                    break
+            self.activity = monotonic()
+        cond.notify()
+
+    def notify_all(self, cond):
+        with self.mut:
+            for entry in self.waiting.values():
+                if entry[0] is cond:
+                    entry[2] = True
+            self.activity = monotonic()
+        cond.notify_all()
+
+    def start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        with self.mut:
+            # busy from the start, so that time waits for its first wait
+            self.threads.add(thread)
+            thread.start()
+        return thread
+
+    def advance(self):
+        """
+        Moves time on to the earliest deadline if every thread is waiting,
+        or if nothing has happened for grace seconds, and wakes the threads
+        whose deadlines have come
+
+        The caller must hold mut.
+        """
+        deadlines = [entry[1] for entry in self.waiting.values()
+                     if entry[1] is not None and not entry[2]]
+        if not deadlines:
+            return
+        self.threads = {t for t in self.threads if t.is_alive()}
+        busy = (any(entry[2] for entry in self.waiting.values()) or
+                any(t not in self.waiting for t in self.threads))
+        if busy and (self.grace is None or
+                     monotonic() - self.activity < self.grace):
+            return
+        self.now = max(self.now, min(deadlines))
+        self.activity = monotonic()
+        for entry in self.waiting.values():
+            if entry[1] is not None and entry[1] <= self.now:
+                # the lock may be held, by us or by a thread about to wait
+                # on it; the waiter then finds out when it next polls
+                if entry[0].acquire(blocking=False):
+                    try:
+                        entry[0].notify_all()
+                    finally:
+                        entry[0].release()
+
+
+class Scheduler:
+    """
+    Runs callbacks at a given time on a single background thread
+
+    The thread is started when the first callback is scheduled.  Callbacks
+    should be short, since they delay every callback scheduled after them.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock or Clock()
+        self.events = []  # heap of [time, tiebreaker, callback, args]
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def call_later(self, delay, callback, *args):
+        """
+        Schedules callback(*args) to run after delay seconds
+
+        Returns an event which may be passed to cancel().
+        """
+        event = [self.clock.monotonic() + delay, next(self.counter), callback,
+                 args]
+        with self.cond:
+            heapq.heappush(self.events, event)
+            if self.events[0] is event:
+                self.clock.notify(self.cond)
+            if self.thread is None:
+                self.thread = self.clock.start_thread(self.run)
+        return event
+
+    def cancel(self, event):
+        """Prevents a scheduled callback from running, if it has not yet"""
+        event[2] = None
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    while self.events and self.events[0][2] is None:
+                        heapq.heappop(self.events)
+                    if not self.events:
+                        self.clock.wait(self.cond)
+                        continue
+                    delay = self.events[0][0] - self.clock.monotonic()
+                    if delay <= 0:
+                        break
+                    self.clock.wait(self.cond, delay)
+                _, _, callback, args = heapq.heappop(self.events)
+            try:
+                callback(*args)
+            except Exception:
+                traceback.print_exc()
 
 
 class Network:
-    def __init__(self, loss=0.0, per=0.0, debug=None):
+    def __init__(self, loss=0.0, per=0.0, debug=None, mtu=None, queued=False,
+                 delay=0.0, jitter=0.0, reorder=0.0, clock=None, seed=None,
+                 channel=None, capture=None, bandwidth=None, queue=None):
         if debug is None:
             debug = 'NET_DEBUG' in os.environ
-        if not hasattr(loss, '__next__'):
-            loss = _trialgen(loss)
-        if not hasattr(per, '__next__'):
-            per = _trialgen(per)
+        # Every random decision the network makes is drawn from here, so a
+        # seed replays the same decisions for the same sequence of packets.
+        # It may also be a random.Random or a NumPy Generator to draw from.
+        if seed is None or isinstance(seed, int):
+            seed = random.Random(seed)
+        self.random = seed
+        # ChannelModels every packet goes through, in order; by default,
+        # independent loss with probability loss, then corruption of a
+        # single byte with probability per
+        if channel is None:
+            channel = [BernoulliLoss(loss), ByteCorruption(per)]
+        self.channel = self.bind_channel(channel, self.random)
         self.hosts = {}
-        self.loss = loss
-        self.per = per
+        # Hosts may transmit from several threads, but the random
+        # generators can only be advanced by one at a time
+        self.trialmut = threading.Lock()
         self.debug = debug
+        # Largest packet (bytes) the network can carry; None for no limit
+        self.mtu = mtu
+        # Deliver packets through each host's inbound queue, drained by a
+        # thread of its own, rather than on the sender's thread; tx then
+        # returns without waiting for the receiver
+        self.queued = queued
+        # Propagation delay (seconds) of every packet, plus a random extra
+        # delay: uniform between 0 and jitter, or jitter() if it is callable.
+        # With probability reorder a packet is sent without any delay,
+        # overtaking those in flight (as netem does).
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder = reorder
+        # Bandwidth (bits per second) of each host's connection to the
+        # network, or None for no limit.  Packets a host sends wait their turn
+        # in a queue managed by a copy of queue (a DropTail by default).
+        self.bandwidth = bandwidth
+        self.queue = queue or DropTail()
+        self.uplinks = {}  # host address -> Bottleneck
+        # Overrides for particular links, mapping (src, dst) to [delay,
+        # jitter, reorder, channel, bottleneck], None meaning the network's
+        self.links = {}
+        # Time for everything on the network; pass a VirtualClock to run in
+        # simulated time
+        self.clock = clock or Clock()
+        # Timers for the network and for protocols running on its hosts;
+        # delayed packets are delivered from here too
+        self.scheduler = Scheduler(self.clock)
+        # Capture recording every packet transmitted, or None
+        self.capture = capture
 
     def attach(self, host, ip):
         if ip in self.hosts:
@@ -40,24 +809,253 @@ class Network:
                              .format(ip))
         self.hosts[ip] = host
 
-    def tx(self, proto, data, src, dst):
+    def set_link(self, src, dst, delay=None, jitter=None, reorder=None,
+                 loss=None, per=None, seed=None, channel=None,
+                 bandwidth=None, queue=None):
+        """
+        Gives packets from src to dst their own delay model, loss rate,
+        corruption rate or list of ChannelModels; parameters left as None
+        keep the network's value
+
+        With bandwidth, the link has a Bottleneck of its own, with queue
+        as its QueueDiscipline, instead of sharing its sender's.
+
+        A loss or corruption rate replaces the network's BernoulliLoss or
+        ByteCorruption and keeps its other models; ValueError is raised if
+        the network has no such model, and channel must be given instead.
+        The link's models draw from generators of their
+        own, seeded with seed if given, so that its pattern does not depend
+        on traffic elsewhere.
+        """
+        rng = random.Random(seed) if seed is not None else None
+        with self.trialmut:
+            if rng is None:
+                rng = _substream(self.random)
+            if channel is None and (loss is not None or per is not None):
+                channel = list(self.channel)
+                for cls, prob in ((BernoulliLoss, loss),
+                                  (ByteCorruption, per)):
+                    if prob is None:
+                        continue
+                    found = [i for i, model in enumerate(channel)
+                             if type(model) is cls]
+                    if not found:
+                        raise ValueError("Network's channel has no {} to "
+                                         "replace; give the link's channel "
+                                         "instead".format(cls.__name__))
+                    for i in found:
+                        channel[i] = cls(prob)
+            if channel is not None:
+                channel = self.bind_channel(channel, rng)
+            bottleneck = None
+            if bandwidth is not None:
+                bottleneck = Bottleneck(bandwidth, queue)
+                bottleneck.discipline.bind(_substream(rng))
+            elif queue is not None:
+                raise ValueError("A link's queue needs a bandwidth")
+            self.links[src, dst] = [delay, jitter, reorder, channel,
+                                    bottleneck]
+
+    @staticmethod
+    def bind_channel(channel, rng):
+        """Gives each model in a channel its own random substream of rng"""
+        channel = list(channel)
+        for model in channel:
+            model.bind(_substream(rng))
+        return channel
+
+    def bottleneck(self, src, dst):
+        """
+        Returns the Bottleneck packets from src to dst go through, or None
+        if their bandwidth is not limited
+
+        The caller must hold trialmut.
+        """
+        link = self.links.get((src, dst))
+        if link is not None and link[4] is not None:
+            return link[4]
+        if self.bandwidth is None:
+            return None
+        uplink = self.uplinks.get(src)
+        if uplink is None:
+            uplink = Bottleneck(self.bandwidth, copy.deepcopy(self.queue))
+            uplink.discipline.bind(_substream(self.random))
+            self.uplinks[src] = uplink
+        return uplink
+
+    def link_delay(self, src, dst):
+        """
+        Draws the delay of a packet from src to dst
+
+        The caller must hold trialmut.
+        """
+        delay, jitter, reorder = self.links.get((src, dst), (None,) * 3)[:3]
+        if delay is None:
+            delay = self.delay
+        if jitter is None:
+            jitter = self.jitter
+        if reorder is None:
+            reorder = self.reorder
+        if reorder and self.random.random() < reorder:
+            return 0.0
+        if callable(jitter):
+            delay += jitter()
+        elif jitter:
+            delay += self.random.uniform(0, jitter)
+        return delay
+
+    def tx(self, proto, data, src, dst, hop=None, sender=None, ttl=None):
+        """
+        Transmits a packet from src to dst, returning its length
+
+        A packet crossing several networks is handed to hop, the address on
+        this network of the router to take it on, from sender, that of the
+        host or router putting it on this one; both default to the ends of
+        the packet.  Link settings and bottlenecks are those between sender
+        and hop.  ttl, if not None, is the number of routers the packet may
+        still cross.
+        """
         # Ensure all transmitted data is encoded to bytes
         if not isinstance(data, bytes):
             raise TypeError("Network can only send bytes, not {}"
                             .format(type(data).__name__))
-        # TODO: add delay and reordering
-        lose = next(self.loss)
+        if self.mtu is not None and len(data) > self.mtu:
+            raise ValueError("Packet of {} bytes exceeds MTU of {}"
+                             .format(len(data), self.mtu))
+        sent = data
+        now = self.clock.monotonic()
+        if hop is None:
+            hop = dst
+        if sender is None:
+            sender = src
+        with self.trialmut:
+            bottleneck = self.bottleneck(sender, hop)
+            delay = 0.0
+            if bottleneck is not None:
+                delay = bottleneck.enqueue(now, len(data))
+            if delay is None:
+                data = None
+            else:
+                link = self.links.get((sender, hop))
+                if link is None or link[3] is None:
+                    channel = self.channel
+                else:
+                    channel = link[3]
+                for model in channel:
+                    data = model.transmit(data)
+                    if data is None:
+                        break
+            if data is not None:
+                delay += self.link_delay(sender, hop)
         if self.debug:
-            print('%s -> %s%s' % (src, dst, ' (LOST!)' if lose else ''),
+            print('%s -> %s%s%s' % (src, dst,
+                                    '' if hop == dst else ' via %s' % (hop,),
+                                    ' (DROPPED!)' if delay is None else
+                                    ' (LOST!)' if data is None else ''),
                   file=sys.stderr)
-            _hexdump(data)
-        if not lose and dst in self.hosts:
-            if next(self.per):
-                pos = random.randint(0, len(data) - 1)
-                byte = random.randint(0, 255)
-                data = data[:pos] + bytes((byte,)) + data[pos+1:]
+            _hexdump(sent)
+        if self.capture is not None:
+            if data is None:
+                self.capture.record(now, src, dst, proto, sent,
+                                    'dropped' if delay is None else 'lost')
+            else:
+                self.capture.record(now, src, dst, proto, data,
+                                    None if data is sent else 'corrupted')
+        if data is not None and hop in self.hosts:
+            if delay > 0:
+                self.scheduler.call_later(delay, self.deliver, proto, data,
+                                          src, dst, hop, ttl)
+            else:
+                self.deliver(proto, data, src, dst, hop, ttl)
+        return len(sent)
+
+    def deliver(self, proto, data, src, dst, hop=None, ttl=None):
+        """
+        Hands a packet which has crossed the network to its destination, or
+        to the router hop to be forwarded
+        """
+        if hop is not None and hop != dst:
+            self.hosts[hop].forward(proto, data, src, dst, ttl)
+        elif self.queued:
+            self.hosts[dst].enqueue(proto, data, src)
+        else:
             self.hosts[dst].input(proto, data, src)
-        return len(data)
+
+
+class ForwardingTable:
+    """
+    Maps IPv4 prefixes, written as "10.1.0.0/16", to routes, finding the
+    route for an address by longest prefix match
+
+    Routes are kept in a dict for each prefix length, so a lookup takes one
+    probe per length in use however many routes there are, and its result
+    is remembered until the table next changes.
+    """
+
+    def __init__(self):
+        self.prefixes = {}  # prefix length -> {network address: route}
+        self.lengths = []  # prefix lengths in use, longest first
+        self.cache = {}  # address -> route
+
+    def __len__(self):
+        return sum(len(routes) for routes in self.prefixes.values())
+
+    @staticmethod
+    def address(addr):
+        """Returns an IPv4 address as an integer"""
+        return int.from_bytes(socket.inet_aton(addr), 'big')
+
+    @classmethod
+    def parse(cls, prefix):
+        """Returns the network address and length of a prefix"""
+        addr, _, length = prefix.partition('/')
+        length = int(length) if length else 32
+        if not 0 <= length <= 32:
+            raise ValueError("Bad prefix length in {}".format(prefix))
+        mask = (0xffffffff << (32 - length)) & 0xffffffff
+        return cls.address(addr) & mask, length
+
+    def add(self, prefix, route):
+        """Adds a route for prefix, replacing any it had"""
+        net, length = self.parse(prefix)
+        if length not in self.prefixes:
+            self.prefixes[length] = {}
+            self.lengths = sorted(self.prefixes, reverse=True)
+        self.prefixes[length][net] = route
+        self.cache.clear()
+
+    def remove(self, prefix):
+        """Removes the route for prefix"""
+        net, length = self.parse(prefix)
+        routes = self.prefixes.get(length, {})
+        if net not in routes:
+            raise KeyError(prefix)
+        del routes[net]
+        if not routes:
+            del self.prefixes[length]
+            self.lengths = sorted(self.prefixes, reverse=True)
+        self.cache.clear()
+
+    def lookup(self, addr):
+        """Returns the route for an address, or None if there is none"""
+        try:
+            return self.cache[addr]
+        except KeyError:
+            pass
+        route = None
+        try:
+            ip = self.address(addr)
+        except (OSError, TypeError):
+            # not an IPv4 address, so only a default route can match
+            route = self.prefixes.get(0, {}).get(0)
+        else:
+            for length in self.lengths:
+                route = self.prefixes[length].get(
+                    ip & (0xffffffff << (32 - length)) & 0xffffffff)
+                if route is not None:
+                    break
+        self.cache[addr] = route
+        return route
 
 
 # Handles:
@@ -67,12 +1065,25 @@ class Network:
 #  - udt_sendto(proto, dst, seg)
 #  - udt_rcv(proto, src, seg)
 class Host:
+    # Routers a packet the host sends may cross
+    TTL = 64
+
     def __init__(self, net, ip):
         self.net = net
         self.ip = ip
         self.protos = {}
         self.net.attach(self, ip)
+        # Networks the host is attached to, by its address on each
+        self.interfaces = {ip: net}
+        # Routes to addresses on other networks, as (network, address on
+        # it to send from, router to send to or None for the destination
+        # itself); packets without a route are sent on the host's network
+        self.routes = ForwardingTable()
         self.test_sock = None
+        # Packets waiting for the worker thread, when the network is queued
+        self.inbound = deque()
+        self.inboundcond = threading.Condition()
+        self.worker = None
 
     def register_protocol(self, class_):
         pid = class_.getid()
@@ -86,12 +1097,98 @@ class Host:
     def socket(self, proto):
         return self.protos[proto].socket()
 
+    def add_interface(self, net, ip, prefix=None):
+        """
+        Attaches the host to another network as ip, with a route to prefix
+        over it if given
+        """
+        net.attach(self, ip)
+        self.interfaces[ip] = net
+        if prefix is not None:
+            self.add_route(prefix, ip=ip)
+
+    def add_route(self, prefix, gateway=None, ip=None):
+        """
+        Routes packets for prefix through the router gateway, or straight to
+        their destination if None, on the network where the host is ip (its
+        first address by default)
+        """
+        if ip is None:
+            ip = self.ip
+        self.routes.add(prefix, (self.interfaces[ip], ip, gateway))
+
     def output(self, proto, data, dst):
-        self.net.tx(proto, data, self.ip, dst)
+        route = self.routes.lookup(dst) if self.routes.lengths else None
+        if route is None:
+            self.net.tx(proto, data, self.ip, dst)
+        else:
+            net, ip, gateway = route
+            net.tx(proto, data, self.ip, dst, gateway, ip, self.TTL)
+
+    def forward(self, proto, data, src, dst, ttl):
+        """
+        Called with packets handed to the host for another; only a Router
+        passes them on
+        """
 
     def input(self, proto, data, src):
         self.protos[proto].input(data, src)
 
+    def enqueue(self, proto, data, src):
+        """
+        Queues an incoming packet to be input on the host's worker thread,
+        which is started with the first packet
+        """
+        with self.inboundcond:
+            self.inbound.append((proto, data, src))
+            self.net.clock.notify(self.inboundcond)
+            if self.worker is None:
+                self.worker = self.net.clock.start_thread(self.run)
+
+    def run(self):
+        while True:
+            with self.inboundcond:
+                while not self.inbound:
+                    self.net.clock.wait(self.inboundcond)
+                proto, data, src = self.inbound.popleft()
+            try:
+                self.input(proto, data, src)
+            except Exception:
+                traceback.print_exc()
+
+
+class Router(Host):
+    """
+    A host joining networks, which forwards packets for other addresses by
+    its routes
+
+    Packets with no route, or which have crossed their ttl of routers, are
+    dropped and counted in unreachable or expired.
+    """
+
+    def __init__(self, net, ip):
+        super().__init__(net, ip)
+        self.forwarded = 0
+        self.unreachable = 0
+        self.expired = 0
+
+    def forward(self, proto, data, src, dst, ttl):
+        if ttl is not None:
+            if ttl <= 1:
+                self.expired += 1
+                return
+            ttl -= 1
+        route = self.routes.lookup(dst)
+        if route is None:
+            self.unreachable += 1
+            return
+        net, ip, gateway = route
+        self.forwarded += 1
+        # packets corrupted on the way here arrive as bytearrays
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        net.tx(proto, data, src, dst, gateway, ip, ttl)
+
 
 class Socket:
     """Base class for sockets associated with a particular protocol"""
@@ -167,6 +1264,27 @@ class DatagramSocket(Socket):
             n = len(data)
         return data[:n], addr
 
+    def recvfrom_into(self, buffer, nbytes=0):
+        """
+        Copies the next buffered message into a writable buffer
+
+        At most nbytes bytes are copied, or len(buffer) if nbytes is 0; the
+        rest of a longer message is discarded, as with recvfrom.  Returns a
+        pair (nbytes, addr) giving the number of bytes copied and the socket
+        address of the source.  Raises ValueError, leaving the message
+        queued, if nbytes exceeds the size of the buffer.
+        """
+
+        view = memoryview(buffer).cast('B')
+        if not nbytes:
+            nbytes = len(view)
+        elif nbytes > len(view):
+            raise ValueError("buffer too small for requested bytes")
+        data, addr = self.msgs.get()
+        n = min(nbytes, len(data))
+        view[:n] = memoryview(data)[:n]
+        return n, addr
+
     def sendto(self, msg, dst):
         raise NotImplementedError
 
@@ -174,6 +1292,9 @@ class DatagramSocket(Socket):
 class StreamSocket(Socket):
     """Base class for sockets with stream semantics"""
 
+    # Clock for recv timeouts; a subclass may use its network's instead
+    clock = Clock()
+
     # Custom exceptions
     class NotBound(Exception):
         """Exception raised when attempting to listen on an unbound socket"""
@@ -202,13 +1323,26 @@ class StreamSocket(Socket):
         already connected
         """
 
+    class Timeout(Exception):
+        """
+        Exception raised when a blocking call does not complete within the
+        given timeout
+        """
+
     # Constructor - subclasses should call using super() as seen here
     def __init__(self, *args, **kwargs):
         """Initializes a new stream socket"""
 
         super().__init__(*args, **kwargs)
-        self.data = b''
+        # Received data is kept as a queue of chunks, so that appending and
+        # consuming are proportional to the size of the chunk rather than
+        # the amount buffered
+        self.chunks = deque()
+        self.offset = 0  # bytes of chunks[0] already consumed
+        self.buffered = 0  # bytes available to recv
+        self.eof = False  # no more data will be delivered
         self.datamut = threading.Lock()
+        self.datacond = threading.Condition(self.datamut)
 
     # Provided methods (you should not override these)
     def deliver(self, data):
@@ -216,28 +1350,123 @@ class StreamSocket(Socket):
         Passes message data (bytes) to the application layer
 
         This data will be appended to a socket buffer where the application can
-        retrieve it later.
+        retrieve it later.  The buffer keeps a reference to data rather than a
+        copy, so it must not be modified afterwards.
+        """
+
+        if not len(data):
+            return
+        with self.datamut:
+            self.chunks.append(memoryview(data).cast('B'))
+            self.buffered += len(self.chunks[-1])
+            self.clock.notify_all(self.datacond)
+
+    def deliver_eof(self):
+        """
+        Marks the end of the stream; once the buffer has been read, recv
+        returns b'' instead of blocking
         """
 
         with self.datamut:
-            self.data += data
+            self.eof = True
+            self.clock.notify_all(self.datacond)
 
-    def recv(self, n=None):
+    def recv(self, n=None, timeout=None):
         """
         Retrieves data from the stream buffer
 
-        Returns n bytes or all currently buffered data, whichever is smaller.
+        Returns n bytes or all currently buffered data, whichever is smaller,
+        or b'' once the buffer is empty at the end of the stream.
 
-        TODO: If buffer is empty, the method should block until more data is
-        delivered.
+        If the buffer is empty, the method blocks until more data is delivered.
+        If that takes longer than timeout seconds (if given), it raises
+        StreamSocket.Timeout.
         """
 
         with self.datamut:
+            if n == 0:
+                return b''
+            self.wait_data(timeout)
             if n is None:
-                n = len(self.data)
-            data, self.data = self.data[:n], self.data[n:]
+                n = self.buffered
+            data = b''.join(self.consume(n))
+        self.consumed()
         return data
 
+    def recv_into(self, buffer, nbytes=0, timeout=None):
+        """
+        Retrieves data from the stream buffer into a writable buffer
+
+        Copies at most nbytes bytes, or len(buffer) if nbytes is 0, straight
+        from the stream buffer without creating an intermediate bytes object.
+        Returns the number of bytes copied, 0 at the end of the stream.
+        Blocks like recv if there is no data.  Raises ValueError, consuming
+        nothing, if nbytes exceeds the size of the buffer.
+        """
+
+        view = memoryview(buffer).cast('B')
+        if not nbytes:
+            nbytes = len(view)
+        elif nbytes > len(view):
+            raise ValueError("buffer too small for requested bytes")
+        with self.datamut:
+            if nbytes == 0:
+                return 0
+            self.wait_data(timeout)
+            ofs = 0
+            for part in self.consume(nbytes):
+                view[ofs:ofs+len(part)] = part
+                ofs += len(part)
+        self.consumed()
+        return ofs
+
+    def readinto(self, buffer):
+        """File-like alias for recv_into(buffer)"""
+        return self.recv_into(buffer)
+
+    def wait_data(self, timeout):
+        """
+        Waits until the buffer is not empty or the stream has ended, raising
+        StreamSocket.Timeout if timeout seconds pass first
+
+        The caller must hold datamut.
+        """
+
+        if not self.clock.wait_for(self.datacond,
+                                   lambda: self.buffered or self.eof, timeout):
+            raise StreamSocket.Timeout
+
+    def consume(self, n):
+        """
+        Removes up to n bytes from the front of the buffer, returning them as
+        a list of memoryviews
+
+        The caller must hold datamut.
+        """
+
+        parts = []
+        while n > 0 and self.chunks:
+            chunk = self.chunks[0]
+            take = min(n, len(chunk) - self.offset)
+            parts.append(chunk[self.offset:self.offset+take])
+            self.offset += take
+            if self.offset == len(chunk):
+                self.chunks.popleft()
+                self.offset = 0
+            self.buffered -= take
+            n -= take
+        return parts
+
+    # Hooks which subclasses may override
+    def consumed(self):
+        """
+        Called after the application takes data from the buffer, without
+        datamut held
+
+        Does nothing by default; a protocol may override it to tell the
+        sender that there is room for more data.
+        """
+
     # Abstract methods, to be overridden in subclasses
     def connect(self, addr):
         """
@@ -290,6 +1519,26 @@ class StreamSocket(Socket):
         """
         raise NotImplementedError
 
+    def shutdown(self, how):
+        """
+        Shuts down the receiving half of the connection (SHUT_RD), the sending
+        half (SHUT_WR), or both (SHUT_RDWR)
+
+        After SHUT_WR the remote side reads the end of the stream once it has
+        received everything sent before it.  If the socket is not connected,
+        this should raise StreamSocket.NotConnected.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Closes the socket, shutting down any connection and releasing its
+        local port
+
+        The socket may not be used again afterwards.
+        """
+        raise NotImplementedError
+
 
 class Protocol:
     """
@@ -2,23 +2,419 @@
 # https://cs.wheaton.edu/~devinpohly/csci357-s20/project-rdt.pdf
 
 
-from network import Protocol, StreamSocket
-from queue import Queue
-from time import sleep
+from network import Protocol, Socket, StreamSocket, SHUT_RD, SHUT_WR, SHUT_RDWR
+from collections import OrderedDict, deque
+import bisect
+import random
+import struct
+import threading
+import traceback
+import zlib
 
 
 # Reserved protocol number for experiments; see RFC 3692
 IPPROTO_RDT = 0xfe
 
+# Segment header, following the checksum: source port, destination port,
+# sequence number, acknowledgment number, flags, number of SACK blocks, window
+HEADER = struct.Struct('!HHIIBBH')
+
+# The window field counts units of 2**WINDOW_SHIFT bytes, so that receive
+# buffers larger than 64 KiB can be advertised
+WINDOW_SHIFT = 4
+
+# Selective acknowledgment block following the header: first sequence number
+# held beyond a gap, and the sequence number just past it
+SACK_BLOCK = struct.Struct('!II')
+MAX_SACK_BLOCKS = 4
+
+# Header flags
+SYN = 0x01
+ACK = 0x02
+FIN = 0x04
+
+# Sequence numbers are unbounded internally and wrap at 32 bits on the wire
+SEQ_MOD = 1 << 32
+
+# ARQ modes for the sliding-window sender (see RDTSocket.mode)
+GO_BACK_N = 'gbn'
+SELECTIVE_REPEAT = 'sr'
+
+
+class Checksum:
+	"""
+	Base class for segment checksum algorithms
+
+	A checksum of SIZE bytes is prepended to every segment.  Algorithms work
+	on any bytes-like objects, so segments are checked through memoryviews
+	rather than sliced copies.
+	"""
+
+	SIZE = 0
+
+	def compute(self, *parts):
+		"""Returns the checksum (bytes) of the concatenation of parts"""
+		raise NotImplementedError
+
+	def seal(self, *parts):
+		"""Returns the concatenation of parts with its checksum prepended"""
+		return b''.join((self.compute(*parts),) + parts)
+
+	def verify(self, seg):
+		"""Checks whether the checksum at the start of a segment is valid"""
+		view = memoryview(seg)
+		return view[:self.SIZE] == self.compute(view[self.SIZE:])
+
+
+class SumChecksum(Checksum):
+	"""Sum of all bytes modulo 256; only catches single-byte errors"""
+
+	SIZE = 1
+
+	def compute(self, *parts):
+		return bytes((sum(sum(part) for part in parts) % 256,))
+
+
+class InternetChecksum(Checksum):
+	"""
+	16-bit one's complement checksum of RFC 1071
+
+	Rather than adding up 16-bit words in Python, each part is read as a
+	single big-endian integer: since 2**16 is 1 modulo 0xffff, reducing that
+	integer modulo 0xffff gives the same result as the one's complement sum.
+	"""
+
+	SIZE = 2
+
+	def compute(self, *parts):
+		total = 0
+		length = 0
+		nonzero = False
+		for part in parts:
+			value = int.from_bytes(part, 'big')
+			nonzero = nonzero or value != 0
+			# appending an odd number of bytes shifts what came before by
+			# one byte rather than a whole word
+			total = (total * (256 if len(part) % 2 else 1) + value) % 0xffff
+			length += len(part)
+		if length % 2:
+			total = total * 256 % 0xffff  # pad with a zero byte
+		if total == 0 and nonzero:
+			total = 0xffff
+		return (~total & 0xffff).to_bytes(2, 'big')
+
+
+class CRC32Checksum(Checksum):
+	"""CRC-32 as computed by zlib; catches all burst errors up to 32 bits"""
+
+	SIZE = 4
+
+	def compute(self, *parts):
+		crc = 0
+		for part in parts:
+			crc = zlib.crc32(part, crc)
+		return crc.to_bytes(4, 'big')
+
+
+class RTTEstimator:
+	"""
+	Retransmission timeout calculation of RFC 6298
+
+	Keeps a smoothed round-trip time and its variation, fed with samples from
+	segments acknowledged without being retransmitted (Karn's rule is up to
+	the caller).  Each expiry of the timer doubles the timeout, until either
+	a new sample arrives or the backoff is cleared because retransmitted
+	data got through.
+	"""
+
+	ALPHA = 1 / 8
+	BETA = 1 / 4
+	K = 4
+
+	def __init__(self, initial, min_rto, max_rto):
+		self.min_rto = min_rto
+		self.max_rto = max_rto
+		self.srtt = None
+		self.rttvar = None
+		self.rto = max(min_rto, min(initial, max_rto))
+
+	def sample(self, rtt):
+		"""Updates the estimate with a measured round-trip time"""
+		if self.srtt is None:
+			self.srtt = rtt
+			self.rttvar = rtt / 2
+		else:
+			self.rttvar += self.BETA * (abs(self.srtt - rtt) - self.rttvar)
+			self.srtt += self.ALPHA * (rtt - self.srtt)
+		self.clear_backoff()
+
+	def clear_backoff(self):
+		"""
+		Returns the timeout to the value given by the current estimate
+
+		Without a sample yet, the backed-off timeout is kept.
+		"""
+		if self.srtt is not None:
+			rto = self.srtt + self.K * self.rttvar
+			self.rto = max(self.min_rto, min(rto, self.max_rto))
+
+	def backoff(self):
+		"""Doubles the timeout after the retransmission timer expires"""
+		self.rto = min(self.rto * 2, self.max_rto)
+
+
+class CongestionControl:
+	"""
+	Base class for congestion control algorithms
+
+	Keeps a congestion window, cwnd, limiting how many segments a connection
+	has in flight, and a slow start threshold, ssthresh.  The sender reports
+	newly acknowledged segments to on_ack, a segment lost while the rest of
+	the window gets through to on_loss (once per window of data), and an
+	expired retransmission timer to on_timeout.  The base class does slow
+	start alone; subclasses decide what happens after it and on loss.
+	"""
+
+	INITIAL_WINDOW = 10  # segments, as in RFC 6928
+
+	def __init__(self):
+		self.cwnd = self.INITIAL_WINDOW
+		self.ssthresh = float('inf')
+
+	def on_ack(self, acked, now):
+		"""Grows the window when acked more segments have arrived"""
+		if self.cwnd < self.ssthresh:
+			self.cwnd += acked
+
+	def on_loss(self, now):
+		"""Shrinks the window when a segment has been lost"""
+		raise NotImplementedError
+
+	def on_timeout(self, now):
+		"""
+		Collapses the window to a single segment after a retransmission
+		timeout, remembering half of it as the slow start threshold
+		"""
+		self.ssthresh = max(self.cwnd / 2, 2)
+		self.cwnd = 1
+
+
+class RenoCongestion(CongestionControl):
+	"""
+	Additive increase, multiplicative decrease as in TCP Reno (RFC 5681)
+
+	After slow start the window grows by one segment per window of
+	acknowledgments, and a loss halves it.
+	"""
+
+	def on_ack(self, acked, now):
+		if self.cwnd < self.ssthresh:
+			super().on_ack(acked, now)
+		else:
+			self.cwnd += acked / self.cwnd
+
+	def on_loss(self, now):
+		self.ssthresh = max(self.cwnd / 2, 2)
+		self.cwnd = self.ssthresh
+
+
+class CubicCongestion(CongestionControl):
+	"""
+	CUBIC congestion control (RFC 8312)
+
+	After a loss the window grows along a cubic function of the time since,
+	flattening out around the size at which the loss happened and probing
+	beyond it only slowly, but never more slowly than Reno would.  A loss
+	cuts the window by 1 - BETA; if it comes before the window has regained
+	its previous maximum, that maximum is lowered further to make room for
+	competing connections (fast convergence).
+	"""
+
+	C = 0.4
+	BETA = 0.7
+
+	def __init__(self):
+		super().__init__()
+		self.w_max = 0  # window when the last loss happened
+		self.k = 0  # seconds the cubic takes to climb back to w_max
+		self.epoch = None  # start of the current congestion avoidance period
+		self.w_est = 0  # window Reno would have reached by now
+
+	def on_ack(self, acked, now):
+		if self.cwnd < self.ssthresh:
+			super().on_ack(acked, now)
+			return
+		if self.epoch is None:
+			self.epoch = now
+			if self.cwnd < self.w_max:
+				self.k = ((self.w_max - self.cwnd) / self.C) ** (1 / 3)
+			else:
+				self.k = 0
+				self.w_max = self.cwnd
+			self.w_est = self.cwnd
+		target = self.C * (now - self.epoch - self.k) ** 3 + self.w_max
+		self.w_est += 3 * (1 - self.BETA) / (1 + self.BETA) * acked / self.cwnd
+		if target < self.w_est:
+			self.cwnd = self.w_est
+		else:
+			target = min(target, 1.5 * self.cwnd)
+			self.cwnd += (target - self.cwnd) / self.cwnd * acked
+
+	def on_loss(self, now):
+		self.epoch = None
+		if self.cwnd < self.w_max:
+			self.w_max = self.cwnd * (1 + self.BETA) / 2
+		else:
+			self.w_max = self.cwnd
+		self.ssthresh = self.cwnd = max(self.cwnd * self.BETA, 2)
+
+	def on_timeout(self, now):
+		self.on_loss(now)
+		self.cwnd = 1
+
+
+class ReassemblyBuffer:
+	"""
+	Data received beyond a gap in the stream
+
+	Segments are merged into contiguous ranges as they arrive, so that once
+	the gap before a range is filled the whole range can be delivered at once,
+	however many segments it arrived in.  Overlapping data, such as a
+	retransmission cut at different boundaries, is stored only once.
+	"""
+
+	def __init__(self):
+		self.starts = []  # sorted starting sequence numbers of the ranges
+		self.ranges = dict()  # start -> bytearray of contiguous data
+		self.size = 0  # bytes held
+
+	def __len__(self):
+		return self.size
+
+	def add(self, seq, data):
+		"""Stores data starting at seq, merging it with the ranges it touches"""
+		starts = self.starts
+		i = bisect.bisect_right(starts, seq)
+		if i and starts[i-1] + len(self.ranges[starts[i-1]]) >= seq:
+			i -= 1
+			start = starts.pop(i)
+			run = self.ranges.pop(start)
+			self.size -= len(run)
+		else:
+			start = seq
+			run = bytearray()
+		end = start + len(run)
+		if seq + len(data) > end:
+			run += data[end-seq:]
+			end = start + len(run)
+		while i < len(starts) and starts[i] <= end:
+			other_start = starts.pop(i)
+			other = self.ranges.pop(other_start)
+			self.size -= len(other)
+			if other_start + len(other) > end:
+				run += memoryview(other)[end-other_start:]
+				end = start + len(run)
+		starts.insert(i, start)
+		self.ranges[start] = run
+		self.size += len(run)
+
+	def pop(self, seq):
+		"""
+		Removes and returns the data from seq up to the next gap, or None if
+		nothing held starts at or before seq
+
+		Data before seq, which has already been delivered, is discarded.
+		"""
+		while self.starts and self.starts[0] <= seq:
+			start = self.starts.pop(0)
+			run = self.ranges.pop(start)
+			self.size -= len(run)
+			if start + len(run) > seq:
+				return memoryview(run)[seq-start:]
+		return None
+
+	def blocks(self, first=None):
+		"""
+		Returns the ranges held as (start, end) pairs, in order except that
+		the one containing first, if given, is moved to the front
+		"""
+		blocks = [(start, start + len(self.ranges[start])) for start in self.starts]
+		if first is not None:
+			i = bisect.bisect_right(self.starts, first) - 1
+			if i >= 0:
+				blocks.insert(0, blocks.pop(i))
+		return blocks
+
+
+def unwrap(seq, ref):
+	"""
+	Recovers a full sequence number from its 32-bit wire form
+
+	Returns the number congruent to seq (mod 2**32) which is closest to the
+	reference point ref, such as the next byte expected.
+	"""
+	return ref + (seq - ref + SEQ_MOD // 2) % SEQ_MOD - SEQ_MOD // 2
+
 
 class RDTSocket(StreamSocket):
 
+	class ConnectionTimeout(Exception):
+		"""
+		Exception raised when the remote host stops acknowledging data, or
+		answering a connection request, that has been retransmitted RETRIES
+		times
+		"""
+
+	# Per-socket defaults; change the instance attributes before connecting
+	# or listening (accepted sockets inherit them from the listening socket)
+	MODE = SELECTIVE_REPEAT
+	WINDOW = 32  # maximum number of unacknowledged segments in flight
+	MSS = 1400  # maximum payload bytes per segment, unless the network has an MTU
+	INITIAL_RTO = 0.01  # retransmission timeout before any RTT is measured
+	MIN_RTO = 0.001
+	MAX_RTO = 1.0
+	RETRIES = 15  # timeouts in a row before a send or handshake gives up
+	# Selective acknowledgments of this many later segments mark a segment
+	# lost, and it is retransmitted without waiting for its timer
+	DUPTHRESH = 3
+	# Congestion control algorithm, a CongestionControl subclass
+	CONGESTION = RenoCongestion
+	# Default limit on both half-open connections and established ones
+	# waiting for accept(); SYNs beyond it are dropped
+	BACKLOG = 128
+	# With nodelay off, send() only copies data into a send buffer of up to
+	# SNDBUF bytes, and a background thread coalesces it into full segments.
+	# A partial segment is held while earlier data is unacknowledged (as in
+	# Nagle's algorithm), but for no longer than COALESCE_DELAY seconds.
+	NODELAY = True
+	SNDBUF = 65536
+	COALESCE_DELAY = 0.001
+	# Received data not yet read by the application, together with data held
+	# beyond a gap, is limited to RCVBUF bytes; the free space is advertised
+	# to the sender as its window
+	RCVBUF = 262144
+	# Seconds an acknowledgment of in-order data may wait for more data to
+	# cover or for outgoing data to ride on; 0 acknowledges every segment
+	ACK_DELAY = 0
+	# Seconds a connection closed from this side lingers after the
+	# exchange of FINs, acknowledging the remote FIN again if it is
+	# retransmitted, before its port may be reused
+	TIME_WAIT = 0.1
+	# Seconds a closed socket waits for the remote side to finish sending
+	# before it is reclaimed regardless
+	FIN_TIMEOUT = 5.0
+	OPTIONS = ('mode', 'window', 'mss', 'initial_rto', 'min_rto', 'max_rto',
+			'nodelay', 'sndbuf', 'coalesce_delay', 'ack_delay', 'congestion',
+			'rcvbuf')
+
 	def __init__(self, *args, **kwargs):
 		"""Initializes a new stream socket"""
 		super().__init__(*args, **kwargs)
 		# Other initialization here
 		
 		self.bound_port = -1
+		# timers and waits run on the network's clock, which may be simulated
+		self.clock = self.proto.host.net.clock
 		
 		self.is_connected = False
 		# only used by connected sockets
@@ -26,9 +422,76 @@ class RDTSocket(StreamSocket):
 		self.remote_port = -1
 
 		self.is_listening = False
-		self.waiting_connections = Queue()  # only used by listening socket
+		# Listening socket state: half-open connections, keyed by remote
+		# address, are [iss, irs, time SYN-ACK last sent, retransmissions,
+		# scheduler event]; no socket exists for them until the handshake
+		# completes and they move to the accept queue
+		self.backlog = self.BACKLOG
+		self.acceptcond = threading.Condition()
+		self.half_open = dict()
+		self.accept_queue = deque()
 
-		self.acked = True  # whether the last sent packet has been acknowledged by the other side
+		# Initial sequence numbers of each direction; the SYN occupies the
+		# ISN, so stream offset 0 goes out as ISN + 1
+		self.iss = 0
+		self.irs = 0
+
+		self.mode = self.MODE
+		self.window = self.WINDOW
+		self.mss = self.proto.mss or self.MSS
+		self.initial_rto = self.INITIAL_RTO
+		self.min_rto = self.MIN_RTO
+		self.max_rto = self.MAX_RTO
+		self.nodelay = self.NODELAY
+		self.sndbuf = self.SNDBUF
+		self.rcvbuf = self.RCVBUF
+		self.coalesce_delay = self.COALESCE_DELAY
+		self.ack_delay = self.ACK_DELAY
+		self.congestion = self.CONGESTION
+
+		# Sender state: sequence numbers are byte offsets into the stream
+		self.sendmut = threading.Lock()
+		# notified whenever an acknowledgment slides the window or the send
+		# buffer changes
+		self.sendcond = threading.Condition(self.sendmut)
+		self.send_buffer = bytearray()  # data not yet cut into segments
+		self.buffered_at = 0  # when the send buffer last became non-empty
+		self.flusher = None  # thread draining the send buffer
+		self.snd_una = 0  # oldest unacknowledged byte
+		self.snd_nxt = 0  # next byte to be queued for sending
+		self.send_queue = deque()  # (seq, payload) not yet transmitted
+		# Scoreboard of segments in flight which have not been acknowledged,
+		# cumulatively or selectively: seq -> [payload, time last sent,
+		# retransmissions, SACKs of segments sent after it]
+		self.unacked = OrderedDict()
+		self.lost = []  # seqs of segments to retransmit without waiting
+		# seqs of segments which timed out, to be retransmitted as the
+		# congestion window allows
+		self.timed_out = deque()
+		# The remote receive window, which ends snd_wnd bytes after the
+		# acknowledgment number snd_wl it was advertised with
+		self.snd_wl = 0
+		self.snd_wnd = 0
+		self.rtt = None  # RTTEstimator, once connected
+		self.cc = None  # instance of the congestion class, once connected
+		self.recover = 0  # snd_nxt when the window was last cut
+		self.timeouts = 0  # consecutive timeouts without an acknowledgment
+
+		# Receiver state
+		self.recvmut = threading.Lock()
+		self.rcv_nxt = 0  # next byte expected from the remote side
+		self.out_of_order = ReassemblyBuffer()  # selective repeat only
+		self.ack_pending = None  # scheduler event for a delayed acknowledgment
+		self.rcv_adv = 0  # right edge of the window last advertised
+
+		# Teardown state: each side's FIN occupies one sequence number
+		# after its last byte of data
+		self.fin_seq = None  # our FIN, once shutdown for writing
+		self.fin_received = False  # the remote FIN has been delivered
+		self.active_close = False  # our FIN went first; linger in TIME_WAIT
+		self.read_shut = False  # incoming data is discarded
+		self.closing = None  # scheduler event which will reclaim the socket
+		self.closed = False  # removed from the protocol's tables
 
 	def bind(self, port):
 		"""
@@ -41,17 +504,18 @@ class RDTSocket(StreamSocket):
 		if self.bound_port != -1:
 			raise super().AlreadyConnected
 
-		if port in self.proto.ports_in_use:
-			raise super().AddressInUse
-
+		self.proto.claim_port(port)
 		self.bound_port = port
-		self.proto.ports_in_use.add(port)
 
-	def listen(self):
+	def listen(self, backlog=None):
 		"""
 		Identifies the stream socket as a listening (server) socket and begins
 		to listen for and queue incoming connections
 
+		At most backlog connections (BACKLOG by default) may be half-open, and
+		at most backlog may wait to be accepted; further SYNs are dropped
+		until there is room, and the client retransmits them.
+
 		If the socket has not been bound to a local address on which to listen,
 		this method should raise StreamSocket.NotBound.  If the socket is
 		already connected, it should raise StreamSocket.AlreadyConnected.
@@ -62,9 +526,11 @@ class RDTSocket(StreamSocket):
 		if self.is_connected:
 			raise super().AlreadyConnected
 
+		if backlog is not None:
+			self.backlog = backlog
 		self.is_listening = True
 
-		self.proto.listening_sockets[self.bound_port] = self
+		self.proto.register(self)
 
 	def accept(self):
 		"""
@@ -75,27 +541,116 @@ class RDTSocket(StreamSocket):
 		to communicate with the connecting client, and the remote socket
 		address.
 
-		If this is called on a socket which is not listening, the method should
-		raise StreamSocket.NotListening.
+		If this is called on a socket which is not listening, or the socket is
+		closed while waiting, the method should raise
+		StreamSocket.NotListening.
 		"""
 		if self.bound_port == -1:
 			raise StreamSocket.NotBound
 
-		if not self.is_listening:
-			raise StreamSocket.NotListening
+		with self.acceptcond:
+			while not self.accept_queue and self.is_listening:
+				self.clock.wait(self.acceptcond)
+			if not self.is_listening:
+				raise StreamSocket.NotListening
+			connected_socket = self.accept_queue.popleft()
+
+		return (connected_socket, (connected_socket.remote_IP, connected_socket.remote_port))
+
+	def handshake(self, seg, rhost, rport):
+		"""
+		Handles a segment (seq, ack, flags, window, sack, data) which arrives
+		at this listening socket from a remote address with no connection
+
+		A SYN opens a half-open connection and is answered with a SYN-ACK,
+		which is retransmitted until the handshake completes; a duplicate SYN
+		has it resent at once.  The SYN is dropped instead if the backlog of
+		half-open or unaccepted connections is full.  An ACK of the SYN-ACK
+		completes the handshake: only then is a socket created for the
+		connection and queued for accept().  Any other segment is dropped.
+		"""
+		seq, ack, flags, window, sack, data = seg
+		key = (rhost, rport)
+		with self.acceptcond:
+			entry = self.half_open.get(key)
+			if flags & SYN and not flags & ACK:
+				if entry is None:
+					if (len(self.half_open) >= self.backlog or
+							len(self.accept_queue) >= self.backlog):
+						return
+					entry = self.half_open[key] = [random.getrandbits(32), seq,
+							None, 0, None]
+					entry[4] = self.proto.host.net.scheduler.call_later(
+							self.initial_rto, self.synack_timeout, key)
+				else:
+					entry[1] = seq
+					entry[3] += 1
+				entry[2] = self.clock.monotonic()
+				synack = self.proto.make_segment(self.bound_port, rport,
+						entry[0], entry[1] + 1, SYN | ACK, self.rcvbuf)
+			elif (flags & ACK and not flags & SYN and entry is not None and
+					ack == (entry[0] + 1) % SEQ_MOD):
+				del self.half_open[key]
+				self.proto.host.net.scheduler.cancel(entry[4])
+				connected_socket = self.promote(entry, rhost, rport, window)
+				self.accept_queue.append(connected_socket)
+				self.clock.notify(self.acceptcond)
+				synack = None
+			else:
+				return
+
+		if synack is not None:
+			super().output(synack, rhost)
+		elif data:
+			# the ACK completing the handshake was lost, but data carries it
+			connected_socket.input(seg, rhost)
+
+	def synack_timeout(self, key):
+		"""
+		Retransmits the SYN-ACK of a half-open connection, backing off each
+		time, and abandons the connection after RETRIES retransmissions
+		"""
+		with self.acceptcond:
+			entry = self.half_open.get(key)
+			if entry is None:
+				return
+			if entry[3] >= self.RETRIES:
+				del self.half_open[key]
+				return
+			entry[2] = self.clock.monotonic()
+			entry[3] += 1
+			entry[4] = self.proto.host.net.scheduler.call_later(
+					min(self.initial_rto * 2 ** entry[3], self.max_rto),
+					self.synack_timeout, key)
+			synack = self.proto.make_segment(self.bound_port, key[1], entry[0],
+					entry[1] + 1, SYN | ACK, self.rcvbuf)
+		super().output(synack, key[0])
 
-		new_connection = self.waiting_connections.get()  # Note: blocks if empty
+	def promote(self, entry, rhost, rport, window):
+		"""
+		Creates and registers the socket for a connection whose handshake has
+		just completed, with the window the client advertised
 
+		The caller must hold acceptcond.
+		"""
 		connected_socket = self.proto.socket()
+		for option in self.OPTIONS:
+			setattr(connected_socket, option, getattr(self, option))
+		connected_socket.rtt = RTTEstimator(self.initial_rto, self.min_rto,
+				self.max_rto)
+		connected_socket.cc = self.congestion()
+		if entry[3] == 0:
+			connected_socket.rtt.sample(self.clock.monotonic() - entry[2])
+		connected_socket.iss = entry[0]
+		connected_socket.irs = entry[1]
+		connected_socket.snd_wnd = window
 		connected_socket.bound_port = self.bound_port
 		connected_socket.is_connected = True
-		connected_socket.remote_IP = new_connection[0]
-		connected_socket.remote_port = new_connection[1]
+		connected_socket.remote_IP = rhost
+		connected_socket.remote_port = rport
 
-		socket_identifier = (connected_socket.bound_port, (connected_socket.remote_IP, connected_socket.remote_port))
-		self.proto.connections[socket_identifier] = connected_socket
-
-		return (connected_socket, (connected_socket.remote_IP, connected_socket.remote_port))
+		self.proto.register(connected_socket)
+		return connected_socket
 
 	def connect(self, addr):
 		"""
@@ -104,6 +659,11 @@ class RDTSocket(StreamSocket):
 		If the socket is not yet bound to a local port, the implementation
 		should choose an unused port for this socket's local address.
 
+		The SYN is retransmitted with exponential backoff until the remote
+		side answers with a SYN-ACK, which is acknowledged to complete the
+		handshake.  If RETRIES retransmissions go unanswered, this method
+		raises RDTSocket.ConnectionTimeout.
+
 		If the socket is already connected, this method should raise
 		StreamSocket.AlreadyConnected.  If the socket is listening, it should
 		raise StreamSocket.AlreadyListening.
@@ -115,27 +675,52 @@ class RDTSocket(StreamSocket):
 			raise super().AlreadyListening
 
 		if self.bound_port == -1:
-			port = 1
-			while port in self.proto.ports_in_use: # find unused port
-				port += 1
-				# No error check for running out of port numbers, but if every
-				# single possible port is in use, we probably have big problems
-				# on our hands anyway
-			self.bind(port)
+			self.bound_port = self.proto.allocate_port()
 
-		self.is_connected = True
+		self.rtt = RTTEstimator(self.initial_rto, self.min_rto, self.max_rto)
+		self.cc = self.congestion()
+		self.iss = random.getrandbits(32)
 
 		self.remote_IP = addr[0]
 		self.remote_port = addr[1]
 
-		socket_identifier = (self.bound_port, (self.remote_IP, self.remote_port))
-		self.proto.connections[socket_identifier] = self
+		self.proto.register(self)
 
-		# send initial message to start the connection on the other side
-		self.send(b'SYN')
-		
-		# TODO: having the SYN and ACK information be a pseudo-payload is
-		# problematic; I should probably just do a flag with S/A or some such
+		syn = self.proto.make_segment(self.bound_port, self.remote_port,
+				self.iss, 0, SYN, self.rcvbuf)
+		try:
+			self.exchange(syn, lambda: self.is_connected)
+		except RDTSocket.ConnectionTimeout:
+			# the socket stays bound to its port
+			self.proto.forget(self)
+			raise
+
+	def exchange(self, seg, done):
+		"""
+		Outputs a control segment and retransmits it, backing off each time,
+		until done() (called with sendmut held) returns true
+
+		Raises RDTSocket.ConnectionTimeout after RETRIES retransmissions.
+		"""
+		retries = 0
+		while True:
+			sent = self.clock.monotonic()
+			super().output(seg, self.remote_IP)
+			with self.sendmut:
+				deadline = sent + self.rtt.rto
+				while not done() and self.clock.monotonic() < deadline:
+					self.clock.wait(self.sendcond,
+							deadline - self.clock.monotonic())
+				if done():
+					if retries == 0:
+						self.rtt.sample(self.clock.monotonic() - sent)
+					else:
+						self.rtt.clear_backoff()
+					return
+				self.rtt.backoff()
+			retries += 1
+			if retries > self.RETRIES:
+				raise RDTSocket.ConnectionTimeout
 
 	def send(self, data):
 		"""
@@ -145,60 +730,766 @@ class RDTSocket(StreamSocket):
 		over a connected socket.  It should handle any socket-level sending
 		behavior, such as setting ARQ timers.
 
-		If the socket is not connected, this should raise
-		StreamSocket.NotConnected.
+		If the socket is not connected, or has been shut down for writing, this
+		should raise StreamSocket.NotConnected.  Raises
+		RDTSocket.ConnectionTimeout if the data could not be delivered; the
+		part of it still unacknowledged is then copied, so that no view into
+		data outlives the call.
 		"""
 		if self.bound_port == -1:
 			raise super().NotBound
 
-		if not self.is_connected:
+		if not self.is_connected or self.fin_seq is not None:
 			raise super().NotConnected
 
-		local_port_string = RDTSocket.port_string(self.bound_port)
-		remote_port_string = RDTSocket.port_string(self.remote_port)
+		view = memoryview(data).cast('B')
+		if not self.nodelay:
+			self.buffer(view)
+			return
 
-		headers = (local_port_string + remote_port_string).encode('utf-8')
-		segment = headers + data
+		# Cut the data into segments and queue them behind anything still
+		# outstanding; the window decides how many are in flight at once.
+		# Segments are views into the caller's buffer, which is not copied
+		# until each one is packed behind its header.
+		with self.sendmut:
+			self.segment_buffer(force=True)
+			for ofs in range(0, len(view), self.mss):
+				self.send_queue.append((self.snd_nxt + ofs,
+						view[ofs:ofs+self.mss]))
+			self.snd_nxt += len(view)
+			end = self.snd_nxt
+		try:
+			self.transmit(end)
+		except RDTSocket.ConnectionTimeout as e:
+			# the caller owns its buffer again once send returns, so copy out
+			# whatever is still queued or unacknowledged, and drop the views
+			# left in the frames the exception carries
+			with self.sendmut:
+				queued = [(seq, bytes(payload))
+						for seq, payload in self.send_queue]
+				self.send_queue.clear()
+				self.send_queue.extend(queued)
+				for entry in self.unacked.values():
+					entry[0] = bytes(entry[0])
+			traceback.clear_frames(e.__traceback__)
+			view.release()
+			raise
 
-		checksum = RDTSocket.checksum(segment)
-		segment = checksum + segment
+	def flush(self):
+		"""
+		Sends any data held in the send buffer without further delay and
+		waits until all data sent so far has been acknowledged
+		"""
+		if not self.is_connected:
+			raise StreamSocket.NotConnected
 
-		self.acked = False
-		counter = 0
-		while not self.acked:
-			if counter == 10:
-				self.acked = True
-				return  # no response is likely to come; time to give up
-			counter += 1
-			super().output(segment, self.remote_IP)
-			sleep(0.001)
+		with self.sendmut:
+			self.segment_buffer(force=True)
+			end = self.snd_nxt
+		self.transmit(end)
 
-	@staticmethod
-	def port_string(port):
+	def shutdown(self, how):
 		"""
-		Converts an integer port number to a string of length 5
+		Shuts down the receiving half of the connection (SHUT_RD), the sending
+		half (SHUT_WR), or both (SHUT_RDWR)
+
+		Shutting down for reading makes recv return b'' once the buffer is
+		empty, and further data is acknowledged but discarded.  Shutting down
+		for writing sends any buffered data, then a FIN, and waits until both
+		have been acknowledged.
+
+		Raises StreamSocket.NotConnected if the socket is not connected, and
+		RDTSocket.ConnectionTimeout if the FIN is retransmitted RETRIES times.
 		"""
-		port_str = str(port)
-		while len(port_str) < 5:
-			port_str = "0" + port_str
-		return port_str
+		if not self.is_connected:
+			raise StreamSocket.NotConnected
 
-	@staticmethod
-	def checksum(segment):
-		return bytes([sum(segment) % 256])
+		if how in (SHUT_RD, SHUT_RDWR) and not self.read_shut:
+			self.read_shut = True
+			self.deliver_eof()
+
+		if how in (SHUT_WR, SHUT_RDWR) and self.fin_seq is None:
+			self.flush()
+			with self.sendmut:
+				self.fin_seq = self.snd_nxt
+				self.snd_nxt += 1
+				self.active_close = not self.fin_received
+				# lets the drain thread finish
+				self.clock.notify_all(self.sendcond)
+			with self.recvmut:
+				self.cancel_delayed_ack()
+				fin = self.make_segment(self.fin_seq, self.rcv_nxt, FIN | ACK)
+			self.exchange(fin, lambda: self.snd_una > self.fin_seq)
+			self.finished()
+
+	def close(self):
+		"""
+		Closes the socket and releases its local port
+
+		A listening socket stops accepting connections; half-open ones are
+		forgotten, and established ones not yet accepted are closed.  A
+		connected socket is shut down in both directions, and is removed from
+		the protocol's tables once the remote side has closed as well: after
+		TIME_WAIT if this side closed first, or after FIN_TIMEOUT if the
+		remote side never does.
+
+		Raises RDTSocket.ConnectionTimeout if data still buffered could not
+		be delivered; the socket is closed anyway.
+		"""
+		if self.is_listening:
+			self.is_listening = False
+			with self.acceptcond:
+				for entry in self.half_open.values():
+					self.proto.host.net.scheduler.cancel(entry[4])
+				self.half_open.clear()
+				pending = list(self.accept_queue)
+				self.accept_queue.clear()
+				# wakes threads waiting in accept
+				self.clock.notify_all(self.acceptcond)
+			self.proto.unregister(self)
+			for sock in pending:
+				sock.close()
+			return
+
+		if not self.is_connected:
+			self.proto.unregister(self)
+			return
+
+		try:
+			self.shutdown(SHUT_RDWR)
+		except RDTSocket.ConnectionTimeout:
+			self.reclaim()
+			# only the FIN went unanswered, unless the data before it did
+			# (fin_seq is unset if flushing the buffer timed out)
+			if self.fin_seq is None or self.snd_una < self.fin_seq:
+				raise
+			return
+		with self.sendmut:
+			if self.closing is None and not self.closed:
+				self.closing = self.proto.host.net.scheduler.call_later(
+						self.FIN_TIMEOUT, self.reclaim)
+
+	def finished(self):
+		"""
+		Reclaims the connection once FINs have been exchanged and acknowledged
+		both ways, lingering in TIME_WAIT first if our FIN went first
+		"""
+		with self.sendmut:
+			if (not self.fin_received or self.fin_seq is None or
+					self.snd_una <= self.fin_seq or self.closed):
+				return
+			if self.active_close:
+				if self.closing is not None:
+					self.proto.host.net.scheduler.cancel(self.closing)
+				self.closing = self.proto.host.net.scheduler.call_later(
+						self.TIME_WAIT, self.reclaim)
+				self.active_close = False
+				return
+		self.reclaim()
+
+	def reclaim(self):
+		"""
+		Removes the socket from the protocol's tables, releasing its port
+		unless another socket shares it, and stops its timers
+		"""
+		with self.sendmut:
+			if self.closed:
+				return
+			self.closed = True
+			if self.closing is not None:
+				self.proto.host.net.scheduler.cancel(self.closing)
+				self.closing = None
+			self.clock.notify_all(self.sendcond)
+		with self.recvmut:
+			self.cancel_delayed_ack()
+		self.proto.unregister(self)
+
+	def transmit(self, end):
+		"""
+		Runs the sender until every byte before end has been acknowledged
+
+		Raises RDTSocket.ConnectionTimeout if too many timeouts occur in a row.
+		"""
+		while True:
+			if self.timeouts > self.RETRIES:
+				raise RDTSocket.ConnectionTimeout
+			for seq, payload in self.due_segments():
+				self.output_data(seq, payload)
+
+			# Sleep until an acknowledgment arrives or the next segment times
+			# out; acknowledgments may already have been processed while the
+			# segments were being output
+			with self.sendmut:
+				if self.snd_una >= end:
+					break
+				if (not self.lost and not self.resendable() and
+						not self.sendable()):
+					self.clock.wait(self.sendcond, self.next_timeout())
+
+	def buffer(self, view):
+		"""
+		Copies data into the send buffer for the background flusher, waiting
+		while the buffer is full
+		"""
+		with self.sendmut:
+			if self.flusher is None or not self.flusher.is_alive():
+				self.flusher = self.clock.start_thread(self.drain)
+			ofs = 0
+			while ofs < len(view):
+				if self.timeouts > self.RETRIES:
+					raise RDTSocket.ConnectionTimeout
+				room = self.sndbuf - len(self.send_buffer)
+				if room <= 0:
+					self.clock.wait(self.sendcond)
+					continue
+				if not self.send_buffer:
+					self.buffered_at = self.clock.monotonic()
+				self.send_buffer += view[ofs:ofs+room]
+				ofs += room
+				self.clock.notify_all(self.sendcond)
+
+	def drain(self):
+		"""
+		Background thread which cuts the send buffer into segments and keeps
+		them moving until the sender times out or is shut down
+		"""
+		while self.timeouts <= self.RETRIES:
+			with self.sendmut:
+				self.segment_buffer()
+				while (not self.send_queue and not self.unacked and
+						self.fin_seq is None):
+					self.clock.wait(self.sendcond, self.coalesce_timeout())
+					self.segment_buffer()
+				# shutdown flushes the buffer before setting fin_seq
+				if not self.send_queue and not self.unacked:
+					break
+
+			for seq, payload in self.due_segments():
+				self.output_data(seq, payload)
+
+			with self.sendmut:
+				self.segment_buffer()
+				if (not self.lost and not self.resendable() and
+						not self.sendable()):
+					timeouts = [t for t in (self.next_timeout(),
+							self.coalesce_timeout()) if t is not None]
+					self.clock.wait(self.sendcond, min(timeouts, default=None))
+
+		# wake any senders waiting for buffer space so they see the error
+		with self.sendmut:
+			self.clock.notify_all(self.sendcond)
+
+	def segment_buffer(self, force=False):
+		"""
+		Moves data from the send buffer into the send queue
+
+		Full segments are always cut.  The remainder is cut as well if force
+		is set, if nodelay is on, if nothing is in flight, or if it has been
+		held for coalesce_delay.  The caller must hold sendmut.
+		"""
+		buf = self.send_buffer
+		if not buf:
+			return
+		ofs = 0
+		expired = self.clock.monotonic() >= self.buffered_at + self.coalesce_delay
+		with memoryview(buf) as view:
+			while len(buf) - ofs >= self.mss or (ofs < len(buf) and (force or
+					self.nodelay or not (self.send_queue or self.unacked) or
+					expired)):
+				payload = bytes(view[ofs:ofs+self.mss])
+				self.send_queue.append((self.snd_nxt, payload))
+				self.snd_nxt += len(payload)
+				ofs += len(payload)
+		if ofs:
+			del buf[:ofs]
+			self.buffered_at = self.clock.monotonic()
+			self.clock.notify_all(self.sendcond)
+
+	def coalesce_timeout(self):
+		"""
+		Returns the number of seconds a partial segment may still be held in
+		the send buffer, or None if the buffer is empty
+
+		The caller must hold sendmut.
+		"""
+		if not self.send_buffer:
+			return None
+		return max(0, self.buffered_at + self.coalesce_delay -
+				self.clock.monotonic())
+
+	def due_segments(self):
+		"""
+		Returns the (seq, payload) pairs that should be transmitted now
+
+		New segments are taken from the send queue while the window has room
+		and the remote receive window can take them.  With nothing in flight,
+		the head of the queue is cut down to what the receive window takes,
+		or to a single byte if it is closed; that byte probes the window until
+		it opens, backing off like a retransmission but never giving up.
+		Segments unacknowledged for longer than the retransmission timeout are
+		resent: in Go-Back-N mode a timeout on the oldest segment expires
+		everything in flight, while in Selective Repeat mode each segment
+		expires only when its own timer does.  Each expiry backs off the
+		timeout.  Only the oldest expired segment is resent at once; the rest
+		are no longer counted in flight, and are resent in order as
+		acknowledgments open the congestion window, so that a timeout does
+		not resend a whole window in one burst.  Segments which selective
+		acknowledgments show to be lost are resent first, without touching
+		the timeout.
+		"""
+		now = self.clock.monotonic()
+		due = []
+		with self.sendmut:
+			for seq in self.lost:
+				entry = self.unacked.get(seq)
+				if entry is not None:
+					entry[1] = now
+					entry[2] += 1
+					entry[3] = 0
+					due.append((seq, entry[0]))
+			self.lost.clear()
+			resent = {seq for seq, payload in due}
+
+			rto = self.rtt.rto
+			if self.mode == GO_BACK_N:
+				oldest = next(iter(self.unacked.values()), None)
+				if oldest is not None and now >= oldest[1] + rto:
+					expired = list(self.unacked)
+				else:
+					expired = []
+			else:
+				expired = [seq for seq, entry in self.unacked.items()
+						if now >= entry[1] + rto]
+			if expired:
+				self.rtt.backoff()
+				# cut the window once, not again as older segments time out;
+				# window probes beyond the receive window are not lost at all
+				if expired[0] < self.snd_wl + self.snd_wnd:
+					self.timeouts += 1
+					if expired[-1] >= self.recover:
+						self.cc.on_timeout(now)
+						self.recover = self.snd_nxt
+				waiting = set(self.timed_out)
+				for seq in expired:
+					entry = self.unacked[seq]
+					# restarts the timer, and makes any acknowledgment of the
+					# segment ambiguous for Karn's rule
+					entry[1] = now
+					entry[2] += 1
+					if seq not in waiting:
+						self.timed_out.append(seq)
+				self.timed_out = deque(sorted(self.timed_out))
+				seq = self.timed_out.popleft()
+				if seq not in resent:
+					due.append((seq, self.unacked[seq][0]))
+					resent.add(seq)
+
+			# segments acknowledged or resent since they timed out are done
+			if self.timed_out:
+				self.timed_out = deque(seq for seq in self.timed_out
+						if seq in self.unacked and seq not in resent)
+			while self.resendable():
+				seq = self.timed_out.popleft()
+				entry = self.unacked[seq]
+				entry[1] = now
+				due.append((seq, entry[0]))
+
+			while self.sendable():
+				seq, payload = self.send_queue.popleft()
+				room = self.snd_wl + self.snd_wnd - seq
+				if room < len(payload):
+					cut = max(room, 1)
+					self.send_queue.appendleft((seq + cut, payload[cut:]))
+					payload = payload[:cut]
+				self.unacked[seq] = [payload, now, 0, 0]
+				due.append((seq, payload))
+		return due
+
+	def resendable(self):
+		"""
+		Returns whether a segment which timed out may be resent, not counting
+		the segments still waiting to be resent as in flight
+
+		The caller must hold sendmut.
+		"""
+		return bool(self.timed_out) and (len(self.unacked) -
+				len(self.timed_out) < self.send_window())
+
+	def sendable(self):
+		"""
+		Returns whether a new segment may be put in flight
+
+		The caller must hold sendmut.
+		"""
+		if not self.send_queue or len(self.unacked) >= self.send_window():
+			return False
+		seq, payload = self.send_queue[0]
+		return not self.unacked or seq + len(payload) <= self.snd_wl + self.snd_wnd
+
+	def send_window(self):
+		"""
+		Returns how many segments may be in flight: window, or the congestion
+		window if that is smaller
+
+		The caller must hold sendmut.
+		"""
+		return max(1, min(self.window, int(self.cc.cwnd)))
+
+	def next_timeout(self):
+		"""
+		Returns the number of seconds until the oldest unacknowledged segment
+		times out, or None if nothing is in flight
+
+		The caller must hold sendmut.
+		"""
+		if not self.unacked:
+			return None
+		if self.mode == GO_BACK_N:
+			sent = next(iter(self.unacked.values()))[1]
+		else:
+			sent = min(entry[1] for entry in self.unacked.values())
+		return max(0, sent + self.rtt.rto - self.clock.monotonic())
+
+	def input(self, seg, host):
+		"""
+		Handles a segment (seq, ack, flags, window, sack, data) demultiplexed
+		to this socket
+
+		Acknowledgments slide the send window, whether they come alone or
+		piggybacked on data.  Data is delivered in order; a Selective Repeat
+		receiver also holds data that arrives early, and once the gap before
+		it is filled delivers everything now contiguous in one piece.  Data
+		beyond the advertised window, which ends where the receive buffer
+		would be full, is dropped.
+
+		Data is answered with a cumulative acknowledgment of the next byte
+		expected, which also carries SACK blocks describing the data held
+		beyond the gap.  An acknowledgment of a segment that arrives out of
+		order or twice is sent at once, with the block holding that segment
+		first.  One for in-order data may be delayed by up to ack_delay
+		seconds, in the hope of covering a second segment or riding along with
+		data sent back.
+
+		A FIN is accepted once everything before it has arrived, and marks
+		the end of the stream; it is acknowledged at once, every time it is
+		received.
+		"""
+		seq, ack, flags, window, sack, data = seg
+		if flags & SYN:
+			# a SYN-ACK answering our SYN, or a duplicate of it if our ACK of
+			# it was lost; anything else is a stray duplicate
+			if flags & ACK and ack == (self.iss + 1) % SEQ_MOD:
+				with self.sendmut:
+					if not self.is_connected:
+						self.irs = seq
+						self.snd_wnd = window
+						self.is_connected = True
+						self.clock.notify_all(self.sendcond)
+				self.send_ack()
+			return
+		if not self.is_connected:
+			return
+		# sequence numbers on the wire are offset by each side's ISN
+		seq = (seq - self.irs - 1) % SEQ_MOD
+		ack = (ack - self.iss - 1) % SEQ_MOD
+		if flags & ACK:
+			blocks = [(unwrap((start - self.iss - 1) % SEQ_MOD, self.snd_una),
+					unwrap((end - self.iss - 1) % SEQ_MOD, self.snd_una))
+					for start, end in sack]
+			self.acknowledge(unwrap(ack, self.snd_una), window, blocks)
+		if not data and not flags & FIN:
+			return
+
+		with self.recvmut:
+			seq = unwrap(seq, self.rcv_nxt)
+			end = seq + len(data)  # where a FIN on this segment sits
+			first = None
+			# the window we advertised ends where the receive buffer would
+			# be full
+			limit = self.rcv_nxt + self.rcvbuf - self.buffered
+			if seq <= self.rcv_nxt < min(seq + len(data), limit):
+				data = data[self.rcv_nxt-seq:limit-seq]
+				if self.out_of_order:
+					# deliver the segment and everything it joins up with
+					self.out_of_order.add(self.rcv_nxt, data)
+					data = self.out_of_order.pop(self.rcv_nxt)
+				if not self.read_shut:
+					self.deliver(data)
+				self.rcv_nxt += len(data)
+				if (self.ack_delay and not flags & FIN and
+						not self.out_of_order and not self.ack_pending):
+					self.ack_pending = self.proto.host.net.scheduler.call_later(
+							self.ack_delay, self.send_ack)
+					return
+			elif (self.mode == SELECTIVE_REPEAT and data and
+					self.rcv_nxt < seq and seq + len(data) <= limit):
+				# a segment sticking out past the window is dropped, to be
+				# retransmitted later
+				self.out_of_order.add(seq, data)
+				first = seq
+			eof = (flags & FIN and not self.fin_received and
+					end == self.rcv_nxt)
+			if eof:
+				self.rcv_nxt += 1
+				self.fin_received = True
+				self.deliver_eof()
+		self.send_ack(first)
+		if eof:
+			self.finished()
+
+	def send_ack(self, first=None):
+		"""
+		Sends a cumulative acknowledgment, replacing any delayed one
+
+		Up to MAX_SACK_BLOCKS ranges of data held beyond a gap are reported
+		along with it, starting with the one containing first if given.  A
+		pure acknowledgment is never retransmitted; if it is lost, the next
+		one covers the same data.
+		"""
+		with self.recvmut:
+			self.cancel_delayed_ack()
+			ack = self.rcv_nxt
+			sack = self.out_of_order.blocks(first)[:MAX_SACK_BLOCKS]
+		super().output(self.make_segment(self.snd_nxt, ack, ACK, sack=sack),
+				self.remote_IP)
+
+	def cancel_delayed_ack(self):
+		"""
+		Cancels a pending delayed acknowledgment, for instance because data
+		about to be sent carries the same acknowledgment
+
+		The caller must hold recvmut.
+		"""
+		if self.ack_pending:
+			self.proto.host.net.scheduler.cancel(self.ack_pending)
+			self.ack_pending = None
+
+	def output_data(self, seq, payload):
+		"""Transmits a data segment with the current acknowledgment piggybacked"""
+		with self.recvmut:
+			self.cancel_delayed_ack()
+			ack = self.rcv_nxt
+		super().output(self.make_segment(seq, ack, ACK, payload), self.remote_IP)
+
+	def acknowledge(self, ack, window, blocks=()):
+		"""
+		Removes acknowledged segments from the window, and takes note of the
+		remote receive window
+
+		Everything before ack has arrived.  In Selective Repeat mode so has
+		everything within the (start, end) ranges in blocks, and a segment
+		still in flight is marked lost once DUPTHRESH acknowledgments have
+		selectively acknowledged segments sent after it.
+		Newly acknowledged segments that were sent only once provide a
+		round-trip time sample.
+		"""
+		now = self.clock.monotonic()
+		acked = []
+		with self.sendmut:
+			if ack >= self.snd_wl:
+				if ack + window > self.snd_wl + self.snd_wnd:
+					self.clock.notify_all(self.sendcond)
+				self.snd_wl = ack
+				self.snd_wnd = window
+			if ack > self.snd_una:
+				# wakes whoever waits for our FIN to be acknowledged, which
+				# pops no segment
+				self.clock.notify_all(self.sendcond)
+				while self.unacked:
+					first = next(iter(self.unacked))
+					if first >= ack:
+						break
+					acked.append(self.unacked.pop(first))
+				self.snd_una = ack
+			if self.mode == SELECTIVE_REPEAT and blocks:
+				sacked = [(seq, entry) for seq, entry in self.unacked.items()
+						if any(start <= seq and seq + len(entry[0]) <= end
+							for start, end in blocks)]
+				for seq, entry in sacked:
+					del self.unacked[seq]
+					acked.append(entry)
+				if sacked:
+					highest = sacked[-1][0]
+					newest = max(entry[1] for seq, entry in sacked)
+					for seq, entry in self.unacked.items():
+						if seq < highest and entry[1] < newest:
+							entry[3] += 1
+							if entry[3] == self.DUPTHRESH:
+								self.lost.append(seq)
+								if seq >= self.recover:
+									self.cc.on_loss(now)
+									self.recover = self.snd_nxt
+			if acked:
+				self.clock.notify_all(self.sendcond)
+				self.timeouts = 0
+				self.cc.on_ack(len(acked), now)
+				# growth beyond the window could never be used, and would
+				# only blunt the next cut
+				self.cc.cwnd = min(self.cc.cwnd, self.window)
+				# Karn's rule: retransmitted segments give ambiguous samples,
+				# but they do show the path is working again, so the backoff
+				# can go (as Linux does) rather than wait for fresh data
+				fresh = [entry for entry in acked if entry[2] == 0]
+				if fresh:
+					self.rtt.sample(now - fresh[-1][1])
+				else:
+					self.rtt.clear_backoff()
+
+	def make_segment(self, seq, ack, flags, data=b'', sack=()):
+		"""
+		Builds a checksummed segment for this connection, taking seq as an
+		offset in our stream, and ack and the SACK blocks as offsets in the
+		remote one
+
+		The segment advertises the free space in the receive buffer.
+		"""
+		window = max(0, self.rcvbuf - self.buffered)
+		self.rcv_adv = ack + window
+		sack = [(self.irs + 1 + start, self.irs + 1 + end) for start, end in sack]
+		return self.proto.make_segment(self.bound_port, self.remote_port,
+				self.iss + 1 + seq, self.irs + 1 + ack, flags, window, data, sack)
+
+	def consumed(self):
+		"""
+		Sends a window update once the application has read enough to open
+		the receive window by a segment or half the buffer, whichever is
+		smaller, so that a sender held up by a full buffer can go on
+		"""
+		if not self.is_connected or self.fin_received:
+			return
+		edge = self.rcv_nxt + self.rcvbuf - self.buffered
+		if edge - self.rcv_adv >= min(self.mss, self.rcvbuf // 2):
+			self.send_ack()
 
 class RDTProtocol(Protocol):
 	PROTO_ID = IPPROTO_RDT
 	SOCKET_CLS = RDTSocket
+	# Checksum algorithm; both ends of a connection must use the same one
+	CHECKSUM = CRC32Checksum
+	# Local ports handed out to sockets which connect without binding
+	EPHEMERAL_PORTS = range(49152, 65536)
 
 	def __init__(self, *args, **kwargs):
 		"""Initialize a new instance of the protocol on the given host"""
 		super().__init__(*args, **kwargs)
 		# Other initialization here
+		self.checksum = self.CHECKSUM()
+		# Largest payload that fits the network's MTU, if it has one
+		self.mss = None
+		if self.host.net.mtu is not None:
+			self.mss = self.host.net.mtu - self.checksum.SIZE - HEADER.size
+		self.portmut = threading.Lock()
 		self.ports_in_use = set()
+		# Ephemeral ports are handed out by a cursor moving through the range,
+		# then from those released since, least recently released first
+		self.next_ephemeral = 0  # index in EPHEMERAL_PORTS of the cursor
+		self.released = deque()
+		self.released_set = set()
 		self.listening_sockets = dict()  # maps port # to the socket listening on that port
 		# self.connections maps (local_port, (remote_IP, remote_port)) to socket
 		self.connections = dict()
+		# Number of listening sockets and connections using each local port
+		self.port_users = dict()
+
+	def claim_port(self, port):
+		"""
+		Marks a specific local port as in use
+
+		Raises Socket.AddressInUse if it already is.
+		"""
+		with self.portmut:
+			if port in self.ports_in_use:
+				raise Socket.AddressInUse
+			self.ports_in_use.add(port)
+
+	def allocate_port(self):
+		"""
+		Picks an unused port from the ephemeral range and marks it in use
+
+		Ports are handed out in rotation, so a released port is reused only
+		after every other free one.  Raises Socket.AddressInUse if the whole
+		range is in use.
+		"""
+		with self.portmut:
+			while self.next_ephemeral < len(self.EPHEMERAL_PORTS):
+				port = self.EPHEMERAL_PORTS[self.next_ephemeral]
+				self.next_ephemeral += 1
+				if port not in self.ports_in_use:
+					self.ports_in_use.add(port)
+					return port
+			# ports bound explicitly since their release are skipped
+			while self.released:
+				port = self.released.popleft()
+				self.released_set.discard(port)
+				if port not in self.ports_in_use:
+					self.ports_in_use.add(port)
+					return port
+			raise Socket.AddressInUse
+
+	def register(self, sock):
+		"""
+		Enters a listening or connecting socket in the listening or
+		connection table
+		"""
+		port = sock.bound_port
+		if sock.is_listening:
+			table, key = self.listening_sockets, port
+		else:
+			table, key = self.connections, (port, (sock.remote_IP,
+					sock.remote_port))
+		with self.portmut:
+			if key not in table:
+				self.port_users[port] = self.port_users.get(port, 0) + 1
+			table[key] = sock
+
+	def forget(self, sock):
+		"""
+		Removes a socket from the connection and listening tables, returning
+		whether its local port is left without a listener or connection
+		(connections accepted by a listener share its port)
+		"""
+		port = sock.bound_port
+		key = (port, (sock.remote_IP, sock.remote_port))
+		with self.portmut:
+			for table, key in ((self.connections, key),
+					(self.listening_sockets, port)):
+				if table.get(key) is sock:
+					del table[key]
+					self.port_users[port] -= 1
+			if self.port_users.get(port) == 0:
+				del self.port_users[port]
+			return port != -1 and port not in self.port_users
+
+	def unregister(self, sock):
+		"""
+		Removes a socket from the connection and listening tables and releases
+		its local port, unless a listener or connection still uses the port
+		"""
+		if self.forget(sock):
+			self.release_port(sock.bound_port)
+
+	def release_port(self, port):
+		"""Marks a local port as free again"""
+		with self.portmut:
+			self.ports_in_use.discard(port)
+			# ports the cursor has yet to reach need not be queued
+			if (port in self.EPHEMERAL_PORTS and
+					self.EPHEMERAL_PORTS.index(port) < self.next_ephemeral and
+					port not in self.released_set):
+				self.released.append(port)
+				self.released_set.add(port)
+
+	def make_segment(self, src_port, dst_port, seq, ack, flags, window,
+			data=b'', sack=()):
+		"""
+		Builds a checksummed segment from raw header fields, with the window
+		given in bytes
+		"""
+		header = HEADER.pack(src_port, dst_port, seq % SEQ_MOD, ack % SEQ_MOD,
+				flags, len(sack), min(window >> WINDOW_SHIFT, 0xffff))
+		blocks = b''.join(SACK_BLOCK.pack(start % SEQ_MOD, end % SEQ_MOD)
+				for start, end in sack)
+		return self.checksum.seal(header, blocks, data)
 
 	def input(self, seg, rhost):
 		"""
@@ -213,13 +1504,19 @@ class RDTProtocol(Protocol):
 		address to the correct socket for handling.
 		"""
 
-		# drop currupt packets
-		if not RDTProtocol.valid_checksum(seg):
+		# drop truncated and currupt packets
+		offset = self.checksum.SIZE
+		if len(seg) < offset + HEADER.size or not self.checksum.verify(seg):
 			return
 
-		remote_port = int(seg[1:6])
-		local_port = int(seg[6:11])
-		data = seg[11:]
+		remote_port, local_port, seq, ack, flags, nsack, window = HEADER.unpack_from(seg, offset)
+		window <<= WINDOW_SHIFT
+		offset += HEADER.size
+		if len(seg) < offset + nsack * SACK_BLOCK.size:
+			return
+		sack = [SACK_BLOCK.unpack_from(seg, offset + i * SACK_BLOCK.size)
+				for i in range(nsack)]
+		data = memoryview(seg)[offset + nsack * SACK_BLOCK.size:]
 
 		if not local_port in self.ports_in_use:
 			return
@@ -228,23 +1525,9 @@ class RDTProtocol(Protocol):
 		#print(self.host.ip + ' received ' + str((local_port, (rhost, remote_port))) + ' containing ' + str(data))
 
 		if right_socket == None:
-			right_socket = self.listening_sockets[local_port]
-			right_socket.waiting_connections.put((rhost, remote_port))
-			if data != b'SYN':
-				pass  # TODO: error handling?
+			listener = self.listening_sockets.get(local_port)
+			if listener is not None:
+				listener.handshake((seq, ack, flags, window, sack, data), rhost,
+						remote_port)
 		else:
-			if data == b'ACK':
-				right_socket.acked = True
-			elif data == b'SYN':
-				pass  # This is *probably* a duplicate packet that's fine to ignore
-			else:
-				right_socket.deliver(data)
-				right_socket.send(b'ACK')
-
-	@staticmethod	
-	def valid_checksum(rdt_segment):
-		"""
-		Checks whether the checksum of this rdt segment is valid
-		"""
-		return rdt_segment[0:1] == RDTSocket.checksum(rdt_segment[1:])
-
+			right_socket.input((seq, ack, flags, window, sack, data), rhost)
@@ -6,6 +6,13 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(sys.argv[0])))
 
 from network import *
 
+import itertools
+import random
+import socket
+import struct
+import tempfile
+import threading
+import time
 import unittest
 import unittest.mock as mock
 
@@ -86,6 +93,14 @@ class A0_NetworkTest(unittest.TestCase):
             self.mh.reset_mock()
             self.mh2.reset_mock()
 
+    def test_mtu(self):
+        n = Network(mtu=10)
+        n.attach(self.mh, '192.168.10.1')
+        n.tx(5, b'0123456789', '192.168.10.2', '192.168.10.1')
+        self.mh.input.assert_called_once_with(5, b'0123456789', '192.168.10.2')
+        with self.assertRaises(ValueError):
+            n.tx(5, b'0123456789a', '192.168.10.2', '192.168.10.1')
+
     def test_missedmsg(self):
         mh3 = mock.MagicMock(name='host 3', spec=Host)
         self.n.tx(2, b'test-missed', '192.168.10.1', '192.168.10.3')
@@ -144,6 +159,431 @@ class A2_ErrorNetworkTest(unittest.TestCase):
         self._test_corruption(90)
 
 
+class A3_SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.s = Scheduler()
+
+    def test_order(self):
+        ran = []
+        done = threading.Event()
+        self.s.call_later(0.03, ran.append, 3)
+        self.s.call_later(0.01, ran.append, 1)
+        self.s.call_later(0.02, ran.append, 2)
+        self.s.call_later(0.04, done.set)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(ran, [1, 2, 3])
+
+    def test_cancel(self):
+        ran = []
+        done = threading.Event()
+        ev = self.s.call_later(0.01, ran.append, 1)
+        self.s.call_later(0.02, done.set)
+        self.s.cancel(ev)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(ran, [])
+
+class A5_VirtualClockTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock()
+        self.s = Scheduler(self.clock)
+
+    def test_order(self):
+        ran = []
+        done = threading.Event()
+        # time would move on between calls made from outside the clock's
+        # threads, were the scheduler not held back
+        with self.s.cond:
+            self.s.call_later(3600, ran.append, 3)
+            self.s.call_later(60, ran.append, 1)
+            self.s.call_later(600, ran.append, 2)
+            self.s.call_later(7200, done.set)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(ran, [1, 2, 3])
+        self.assertEqual(self.clock.monotonic(), 7200)
+
+    def test_wait(self):
+        cond = threading.Condition()
+        start = time.monotonic()
+        with cond:
+            self.assertFalse(self.clock.wait(cond, 86400))
+        self.assertEqual(self.clock.monotonic(), 86400)
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_notify(self):
+        cond = threading.Condition()
+        with cond:
+            self.s.call_later(10, self._notify, cond)
+            self.assertTrue(self.clock.wait(cond, 20))
+        self.assertEqual(self.clock.monotonic(), 10)
+
+    def _blocked_wait(self, clock):
+        """
+        Waits 10 simulated seconds while a clock thread is blocked outside
+        the clock for 0.2 real ones, returning the real time taken
+        """
+        release = threading.Event()
+        clock.start_thread(release.wait, 5)
+        timer = threading.Timer(0.2, release.set)
+        timer.start()
+        cond = threading.Condition()
+        start = time.monotonic()
+        with cond:
+            self.assertFalse(clock.wait(cond, 10))
+        elapsed = time.monotonic() - start
+        timer.join()
+        self.assertEqual(clock.monotonic(), 10)
+        return elapsed
+
+    def test_busy(self):
+        self.assertGreaterEqual(self._blocked_wait(self.clock), 0.2)
+
+    def test_grace(self):
+        self.assertLess(self._blocked_wait(VirtualClock(grace=0.01)), 0.2)
+
+    def _notify(self, cond):
+        with cond:
+            self.clock.notify_all(cond)
+
+    def test_delay(self):
+        n = Network(delay=30, clock=self.clock)
+        h1 = Host(n, '192.168.10.1')
+        h2 = Host(n, '192.168.10.2')
+        h2.register_protocol(PC2)
+        got = []
+        cond = threading.Condition()
+        def input(data, src):
+            with cond:
+                got.append((data, self.clock.monotonic()))
+                self.clock.notify_all(cond)
+        PC2.last_inst.input = input
+        h1.output(2, b'test-virtual', '192.168.10.2')
+        with cond:
+            self.assertTrue(self.clock.wait_for(cond, lambda: got, 60))
+        self.assertEqual(got, [(b'test-virtual', 30)])
+
+class A4_DelayNetworkTest(unittest.TestCase):
+    def setUp(self):
+        self.arrived = []
+        self.done = threading.Event()
+        self.mh = mock.MagicMock(name='host', spec=Host)
+        self.mh.input.side_effect = self._input
+
+    def _input(self, proto, data, src):
+        self.arrived.append((data, time.monotonic()))
+        if len(self.arrived) == self.expect:
+            self.done.set()
+
+    def _send(self, n, count):
+        self.expect = count
+        n.attach(self.mh, '192.168.10.1')
+        sent = time.monotonic()
+        for i in range(count):
+            n.tx(7, b'%05d' % i, '192.168.10.2', '192.168.10.1')
+        self.assertTrue(self.done.wait(5))
+        return sent
+
+    def test_delay(self):
+        sent = self._send(Network(delay=0.05), 100)
+        self.assertEqual([data for data, t in self.arrived],
+                         [b'%05d' % i for i in range(100)])
+        self.assertGreaterEqual(self.arrived[0][1] - sent, 0.05)
+
+    def test_jitter(self):
+        self._send(Network(delay=0.01, jitter=0.01), 1000)
+        order = [data for data, t in self.arrived]
+        self.assertNotEqual(order, sorted(order))
+        self.assertEqual(sorted(order), [b'%05d' % i for i in range(1000)])
+
+    def test_reorder(self):
+        sent = self._send(Network(delay=0.1, reorder=0.25), 1000)
+        early = [data for data, t in self.arrived if t - sent < 0.05]
+        self.assertGreater(len(early), 150)
+        self.assertLess(len(early), 350)
+        self.assertEqual([data for data, t in self.arrived[:len(early)]],
+                         early)
+
+    def test_link(self):
+        n = Network(delay=5)
+        n.set_link('192.168.10.2', '192.168.10.1', delay=0)
+        sent = self._send(n, 10)
+        self.assertLess(self.arrived[-1][1] - sent, 1)
+
+    def test_many(self):
+        self._send(Network(delay=0.2, jitter=lambda: random.expovariate(100)),
+                   20000)
+        self.assertEqual(len(self.arrived), 20000)
+
+
+class A6_SeededNetworkTest(unittest.TestCase):
+    def _pattern(self, n, src='192.168.10.2'):
+        mh = mock.MagicMock(name='host', spec=Host)
+        n.attach(mh, '192.168.10.1')
+        for i in range(2000):
+            n.tx(7, b'%04d' % i, src, '192.168.10.1')
+        return [args[1] for args, kwargs in mh.input.call_args_list]
+
+    def test_trials(self):
+        for prob in (0.0, 0.01, 0.3, 1.0):
+            hits = sum(itertools.islice(trials(prob, random.Random(1)),
+                                        100000))
+            self.assertAlmostEqual(hits / 100000, prob, delta=0.01)
+
+    def test_replay(self):
+        first = self._pattern(Network(loss=0.3, per=0.2, seed=42))
+        self.assertEqual(self._pattern(Network(loss=0.3, per=0.2, seed=42)),
+                         first)
+        self.assertNotEqual(self._pattern(Network(loss=0.3, per=0.2,
+                                                  seed=43)), first)
+
+    def test_link_seed(self):
+        patterns = []
+        for seed in (1, 2):
+            n = Network(seed=seed)
+            n.set_link('192.168.10.2', '192.168.10.1', loss=0.5, seed=7)
+            patterns.append(self._pattern(n))
+        self.assertEqual(patterns[0], patterns[1])
+        self.assertLess(len(patterns[0]), 1500)
+
+
+class A7_ChannelModelTest(unittest.TestCase):
+    def _run(self, model, packets, data=b'0123456789'):
+        model.bind(random.Random(5))
+        return [model.transmit(data) for i in range(packets)]
+
+    def test_gilbert_elliott(self):
+        out = self._run(GilbertElliott(0.01, 0.25), 100000)
+        lost = [pkt is None for pkt in out]
+        bursts = sum(1 for prev, cur in zip([False] + lost, lost)
+                     if cur and not prev)
+        self.assertAlmostEqual(sum(lost) / len(lost), 0.01 / 0.26,
+                               delta=0.01)
+        self.assertAlmostEqual(sum(lost) / bursts, 4, delta=0.5)
+
+    def test_bit_errors(self):
+        data = bytes(125)
+        out = self._run(BitErrors(0.001), 1000, data)
+        flips = sum(bin(byte).count('1') for pkt in out for byte in pkt)
+        self.assertGreater(flips, 800)
+        self.assertLess(flips, 1200)
+        self.assertEqual(data, bytes(125))
+
+    def test_byte_corruption(self):
+        data = b'x' * 100
+        for pkt in self._run(ByteCorruption(1.0, count=3), 100, data):
+            self.assertEqual(len(pkt), 100)
+            self.assertLessEqual(sum(a != b for a, b in zip(pkt, data)), 3)
+        self.assertEqual(data, b'x' * 100)
+
+    def test_truncation(self):
+        for pkt in self._run(Truncation(1.0), 100):
+            self.assertLess(len(pkt), 10)
+            self.assertEqual(pkt, b'0123456789'[:len(pkt)])
+
+    def test_link_channel(self):
+        n = Network(seed=3)
+        mh = mock.MagicMock(name='host', spec=Host)
+        n.attach(mh, '192.168.10.1')
+        n.set_link('192.168.10.3', '192.168.10.1',
+                   channel=[GilbertElliott(1.0, 0.0), Truncation(1.0)])
+        for i in range(10):
+            n.tx(7, b'test-channel', '192.168.10.3', '192.168.10.1')
+        mh.input.assert_not_called()
+        n.tx(7, b'test-channel', '192.168.10.2', '192.168.10.1')
+        mh.input.assert_called_once_with(7, b'test-channel', '192.168.10.2')
+
+    def test_link_rates(self):
+        errors = BitErrors(0.01)
+        n = Network(channel=[errors, BernoulliLoss(0.1)])
+        n.set_link('192.168.10.2', '192.168.10.1', loss=0.5)
+        channel = n.links['192.168.10.2', '192.168.10.1'][3]
+        self.assertIs(channel[0], errors)
+        self.assertIsInstance(channel[1], BernoulliLoss)
+        self.assertEqual(channel[1].prob, 0.5)
+        with self.assertRaises(ValueError):
+            n.set_link('192.168.10.2', '192.168.10.1', per=0.5)
+        n = Network(channel=[GilbertElliott(0.01, 0.25)])
+        with self.assertRaises(ValueError):
+            n.set_link('192.168.10.2', '192.168.10.1', loss=0.5)
+
+
+class A8_CaptureTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.pcapng')
+        os.close(fd)
+        self.addCleanup(os.unlink, self.path)
+
+    def _read(self):
+        """Returns (src, dst, proto, payload, comment) for each packet"""
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        self.assertEqual(struct.unpack_from('<II', data, 8)[0], 0x1A2B3C4D)
+        packets = []
+        ofs = 0
+        types = []
+        while ofs < len(data):
+            btype, total = struct.unpack_from('<II', data, ofs)
+            self.assertEqual(struct.unpack_from('<I', data, ofs+total-4)[0],
+                             total)
+            types.append(btype)
+            if btype == 6:
+                caplen, = struct.unpack_from('<I', data, ofs+20)
+                pkt = data[ofs+28:ofs+28+caplen]
+                opts = data[ofs+28+caplen+(-caplen % 4):ofs+total-4]
+                comment = None
+                if opts[:2] == b'\x01\x00':
+                    olen, = struct.unpack_from('<H', opts, 2)
+                    comment = opts[4:4+olen].decode()
+                packets.append((socket.inet_ntoa(pkt[12:16]),
+                                socket.inet_ntoa(pkt[16:20]), pkt[9],
+                                pkt[20:], comment))
+            ofs += total
+        self.assertEqual(types[:2], [0x0A0D0D0A, 1])
+        return packets
+
+    def test_capture(self):
+        with Capture(self.path) as cap:
+            n = Network(capture=cap)
+            mh = mock.MagicMock(name='host', spec=Host)
+            n.attach(mh, '192.168.10.1')
+            n.tx(7, b'hello', '192.168.10.2', '192.168.10.1')
+            n.set_link('192.168.10.3', '192.168.10.1', loss=1.0)
+            n.tx(8, b'dropped', '192.168.10.3', '192.168.10.1')
+            n.set_link('192.168.10.4', '192.168.10.1', per=1.0)
+            n.tx(9, b'mangled', '192.168.10.4', '192.168.10.1')
+        out = self._read()
+        self.assertEqual(out[0], ('192.168.10.2', '192.168.10.1', 7,
+                                  b'hello', None))
+        self.assertEqual(out[1], ('192.168.10.3', '192.168.10.1', 8,
+                                  b'dropped', 'lost'))
+        self.assertEqual(out[2][:3], ('192.168.10.4', '192.168.10.1', 9))
+        self.assertNotEqual(out[2][3], b'mangled')
+        self.assertEqual(out[2][4], 'corrupted')
+
+    def test_filter(self):
+        with Capture(self.path,
+                     filter=lambda src, dst, proto, data: proto == 8) as cap:
+            n = Network(capture=cap)
+            for i in range(10):
+                n.tx(7 + i % 2, bytes([i]), '192.168.10.2', '192.168.10.1')
+        self.assertEqual([pkt[3] for pkt in self._read()],
+                         [bytes([i]) for i in range(1, 10, 2)])
+
+    def test_ring(self):
+        with Capture(self.path, ring=5, bufsize=1) as cap:
+            n = Network(capture=cap)
+            for i in range(100):
+                n.tx(7, bytes([i]), '192.168.10.2', '192.168.10.1')
+        self.assertEqual([pkt[3] for pkt in self._read()],
+                         [bytes([i]) for i in range(95, 100)])
+
+    def test_buffer(self):
+        cap = Capture(self.path, bufsize=1000)
+        n = Network(capture=cap)
+        n.tx(7, b'x' * 100, '192.168.10.2', '192.168.10.1')
+        cap.file.flush()
+        self.assertEqual(self._read(), [])
+        for i in range(10):
+            n.tx(7, b'x' * 100, '192.168.10.2', '192.168.10.1')
+        cap.file.flush()
+        self.assertGreater(len(self._read()), 0)
+        cap.close()
+        self.assertEqual(len(self._read()), 11)
+
+    def test_snaplen(self):
+        with Capture(self.path, snaplen=30) as cap:
+            Network(capture=cap).tx(7, bytes(100), '192.168.10.2',
+                                    '192.168.10.1')
+        self.assertEqual(self._read()[0][3], bytes(10))
+
+
+class A9_BottleneckTest(unittest.TestCase):
+    def _load(self, discipline, packets, spacing, size=1000):
+        """
+        Offers packets of size bytes every spacing seconds to an 8 kbit/s
+        bottleneck, returning it and the waits of those sent
+        """
+        discipline.bind(random.Random(9))
+        b = Bottleneck(8000, discipline)
+        waits = []
+        for i in range(packets):
+            left = b.enqueue(i * spacing, size)
+            if left is not None:
+                waits.append(left - size * 8 / 8000)
+        return b, waits
+
+    def test_serialize(self):
+        b, waits = self._load(DropTail(), 5, 0.25)
+        self.assertEqual(waits, [0.0, 0.75, 1.5, 2.25, 3.0])
+        self.assertEqual(b.backlog(1.0), 4)
+        self.assertEqual(b.backlog(5.0), 0)
+        self.assertEqual((b.packets, b.bytes, b.drops, b.peak),
+                         (5, 5000, 0, 4))
+        self.assertEqual(b.queue_delay, 7.5)
+
+    def test_droptail(self):
+        b, waits = self._load(DropTail(10), 100, 0.5)
+        self.assertEqual(b.peak, 10)
+        self.assertEqual(b.drops, 100 - len(waits))
+        self.assertGreater(b.drops, 40)
+        self.assertLessEqual(max(waits), 9)
+
+    def test_red(self):
+        b, waits = self._load(RED(100, min_th=5, max_th=15, weight=0.1),
+                              2000, 0.8)
+        self.assertGreater(b.drops, 0)
+        self.assertLess(b.peak, 30)
+
+    def test_codel(self):
+        b, waits = self._load(CoDel(target=0.5, interval=10), 2000, 0.9)
+        self.assertGreater(b.drops, 0)
+        # the standing queue is kept down to around a few packets
+        self.assertLess(sum(waits[-200:]) / 200, 5)
+        # and, once the load goes, nothing more is dropped
+        drops = b.drops
+        for i in range(100):
+            self.assertIsNotNone(b.enqueue(3000 + i * 2, 1000))
+        self.assertEqual(b.drops, drops)
+
+    def test_network(self):
+        clock = VirtualClock()
+        n = Network(clock=clock, bandwidth=8000, delay=1,
+                    queue=DropTail(5))
+        got = []
+        cond = threading.Condition()
+        def input(proto, data, src):
+            with cond:
+                got.append((data, clock.monotonic()))
+                clock.notify_all(cond)
+        mh = mock.MagicMock(name='host', spec=Host)
+        mh.input.side_effect = input
+        n.attach(mh, '192.168.10.1')
+        with n.scheduler.cond:
+            for i in range(10):
+                n.tx(7, bytes(1000), '192.168.10.2', '192.168.10.1')
+        with cond:
+            self.assertTrue(clock.wait_for(cond, lambda: len(got) == 5, 60))
+        self.assertEqual([t for data, t in got], [2, 3, 4, 5, 6])
+        uplink = n.bottleneck('192.168.10.2', '192.168.10.1')
+        self.assertEqual((uplink.packets, uplink.drops), (5, 5))
+        self.assertIs(n.bottleneck('192.168.10.2', '192.168.10.3'), uplink)
+        self.assertIsNot(n.bottleneck('192.168.10.3', '192.168.10.1'), uplink)
+
+    def test_link(self):
+        n = Network(bandwidth=8000)
+        n.set_link('192.168.10.2', '192.168.10.1', bandwidth=80000,
+                   queue=RED())
+        with n.trialmut:
+            link = n.bottleneck('192.168.10.2', '192.168.10.1')
+            self.assertEqual(link.bandwidth, 80000)
+            self.assertIsInstance(link.discipline, RED)
+            self.assertEqual(n.bottleneck('192.168.10.2',
+                                          '192.168.10.3').bandwidth, 8000)
+        self.assertRaises(ValueError, n.set_link, '192.168.10.2',
+                          '192.168.10.3', queue=CoDel())
+        self.assertIsNone(Network().bottleneck('192.168.10.2',
+                                               '192.168.10.1'))
+
+
 class B_HostTest(unittest.TestCase):
     def setUp(self):
         self.mn = mock.MagicMock(name='network', spec=Network)
@@ -192,6 +632,46 @@ class B_HostTest(unittest.TestCase):
         with self.assertRaises(KeyError):
             s = self.h1.socket(2)
 
+class B1_ForwardingTableTest(unittest.TestCase):
+    def setUp(self):
+        self.t = ForwardingTable()
+        self.t.add('0.0.0.0/0', 'default')
+        self.t.add('10.0.0.0/8', 'ten')
+        self.t.add('10.1.0.0/16', 'ten-one')
+        self.t.add('10.1.2.3', 'host')
+
+    def test_lookup(self):
+        self.assertEqual(self.t.lookup('10.1.2.3'), 'host')
+        self.assertEqual(self.t.lookup('10.1.2.4'), 'ten-one')
+        self.assertEqual(self.t.lookup('10.2.0.1'), 'ten')
+        self.assertEqual(self.t.lookup('192.168.10.1'), 'default')
+        self.assertEqual(self.t.lookup('not-an-address'), 'default')
+        self.assertEqual(len(self.t), 4)
+
+    def test_change(self):
+        self.assertEqual(self.t.lookup('10.1.2.4'), 'ten-one')
+        self.t.remove('10.1.0.0/16')
+        self.assertEqual(self.t.lookup('10.1.2.4'), 'ten')
+        self.t.add('10.1.2.0/24', 'ten-one-two')
+        self.assertEqual(self.t.lookup('10.1.2.4'), 'ten-one-two')
+        self.t.remove('0.0.0.0/0')
+        self.assertIsNone(self.t.lookup('192.168.10.1'))
+        self.assertRaises(KeyError, self.t.remove, '0.0.0.0/0')
+        self.assertRaises(ValueError, self.t.add, '10.0.0.0/33', 'bad')
+
+    def test_unaligned(self):
+        self.t.add('172.16.5.9/12', 'private')
+        self.assertEqual(self.t.lookup('172.31.255.255'), 'private')
+        self.assertEqual(self.t.lookup('172.32.0.0'), 'default')
+
+    def test_many(self):
+        for i in range(5000):
+            self.t.add('10.3.%d.%d' % (i // 256, i % 256), i)
+        for i in range(0, 5000, 7):
+            self.assertEqual(self.t.lookup('10.3.%d.%d' % (i // 256, i % 256)),
+                             i)
+        self.assertEqual(self.t.lookup('10.3.200.1'), 'ten')
+
 class C_L3CommTest(unittest.TestCase):
     def setUp(self):
         self.n = Network()
@@ -204,6 +684,132 @@ class C_L3CommTest(unittest.TestCase):
         self.mh.input.assert_called_once_with(6, b'test-output3',
                 '192.168.10.1')
 
+class C_QueuedL3CommTest(unittest.TestCase):
+    def setUp(self):
+        self.n = Network(queued=True)
+        self.h1 = Host(self.n, '192.168.10.1')
+        self.h2 = Host(self.n, '192.168.10.2')
+        self.h2.register_protocol(PC2)
+        self.p2 = PC2.last_inst
+
+    def test_output(self):
+        got = threading.Event()
+        self.p2.input = mock.MagicMock(name='input',
+                                       side_effect=lambda *a: got.set())
+        self.h1.output(2, b'test-queued', '192.168.10.2')
+        self.assertTrue(got.wait(5))
+        self.p2.input.assert_called_once_with(b'test-queued', '192.168.10.1')
+
+    def test_nowait(self):
+        release = threading.Event()
+        order = []
+        def slow(data, src):
+            release.wait(5)
+            order.append(data)
+        self.p2.input = slow
+        self.h1.output(2, b'first', '192.168.10.2')
+        self.h1.output(2, b'second', '192.168.10.2')
+        self.assertEqual(order, [])
+        self.assertIsNot(self.h2.worker, threading.current_thread())
+        release.set()
+        deadline = time.monotonic() + 5
+        while len(order) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(order, [b'first', b'second'])
+
+class C_RoutedL3CommTest(unittest.TestCase):
+    """
+    h1 -- 10.1.0.0/24 -- r1 -- 10.2.0.0/24 -- r2 -- 10.3.0.0/24 -- h2
+    """
+    def setUp(self, hops=None):
+        self.clock = VirtualClock()
+        self.nets = [Network(clock=self.clock, delay=hop + 1,
+                             **(hops or {}).get(hop, {}))
+                     for hop in range(3)]
+        self.h1 = Host(self.nets[0], '10.1.0.1')
+        self.r1 = Router(self.nets[0], '10.1.0.254')
+        self.r1.add_interface(self.nets[1], '10.2.0.1', '10.2.0.0/24')
+        self.r2 = Router(self.nets[1], '10.2.0.2')
+        self.r2.add_interface(self.nets[2], '10.3.0.254', '10.3.0.0/24')
+        self.h2 = Host(self.nets[2], '10.3.0.1')
+        self.h1.add_route('0.0.0.0/0', '10.1.0.254')
+        self.h2.add_route('0.0.0.0/0', '10.3.0.254')
+        self.r1.add_route('10.1.0.0/24')
+        self.r1.add_route('10.3.0.0/16', '10.2.0.2', '10.2.0.1')
+        self.r2.add_route('0.0.0.0/0', '10.2.0.1')
+        self.got = []
+        self.cond = threading.Condition()
+        for h in (self.h1, self.h2):
+            h.register_protocol(PC2)
+            PC2.last_inst.input = self._input
+
+    def _input(self, data, src):
+        with self.cond:
+            self.got.append((data, src, self.clock.monotonic()))
+            self.clock.notify_all(self.cond)
+
+    def _wait(self, count):
+        with self.cond:
+            return self.clock.wait_for(self.cond,
+                                       lambda: len(self.got) >= count, 60)
+
+    def test_output(self):
+        with self.nets[0].scheduler.cond:
+            self.h1.output(2, b'test-routed', '10.3.0.1')
+        self.assertTrue(self._wait(1))
+        # one second on the first network, two on the next, three on the last
+        self.assertEqual(self.got, [(b'test-routed', '10.1.0.1', 6)])
+        self.assertEqual((self.r1.forwarded, self.r2.forwarded), (1, 1))
+
+    def test_reply(self):
+        with self.nets[2].scheduler.cond:
+            self.h2.output(2, b'test-back', '10.1.0.1')
+        self.assertTrue(self._wait(1))
+        self.assertEqual(self.got, [(b'test-back', '10.3.0.1', 6)])
+
+    def test_router_address(self):
+        with self.nets[0].scheduler.cond:
+            self.h1.output(2, b'test-r2', '10.2.0.2')
+        self.r2.register_protocol(PC2)
+        PC2.last_inst.input = self._input
+        self.assertTrue(self._wait(1))
+        self.assertEqual(self.got, [(b'test-r2', '10.1.0.1', 3)])
+
+    def test_hop_loss(self):
+        self.setUp({1: {'loss': 1.0}})
+        for i in range(10):
+            self.h1.output(2, b'test-lost', '10.3.0.1')
+        with self.cond:
+            self.clock.wait(self.cond, 60)
+        self.assertEqual(self.r1.forwarded, 10)
+        self.assertEqual(self.r2.forwarded, 0)
+
+    def test_hop_corruption(self):
+        self.setUp({0: {'per': 1.0}})
+        self.h1.output(2, b'test-corrupted', '10.3.0.1')
+        self.assertTrue(self._wait(1))
+        data, src, t = self.got[0]
+        self.assertEqual(len(data), len(b'test-corrupted'))
+        self.assertNotEqual(data, b'test-corrupted')
+        self.assertEqual(self.r2.forwarded, 1)
+
+    def test_unreachable(self):
+        self.h2.output(2, b'test-nowhere', '10.4.0.1')
+        with self.cond:
+            self.clock.wait(self.cond, 60)
+        # r2 passes it on to r1, which has no route for it
+        self.assertEqual((self.r1.unreachable, self.r2.unreachable), (1, 0))
+        self.assertEqual(self.got, [])
+
+    def test_loop(self):
+        self.r1.add_route('0.0.0.0/0', '10.2.0.2', '10.2.0.1')
+        self.h1.output(2, b'test-loop', '10.9.9.9')
+        with self.cond:
+            self.clock.wait(self.cond, 1000)
+        self.assertEqual(self.r1.expired + self.r2.expired, 1)
+        self.assertEqual(self.r1.forwarded + self.r2.forwarded,
+                         Host.TTL - 1)
+
 class D_ProtocolTest(unittest.TestCase):
     def setUp(self):
         self.mh = mock.MagicMock(name='host', spec=Host)
@@ -262,6 +868,25 @@ class G_DatagramSocketTest(unittest.TestCase):
         self.assertEqual(self.ds.recvfrom(100), (b'1test-trunc-test-trunc', '192.168.10.1'))
         self.assertEqual(self.ds.recvfrom(12), (b'2test-trunc-', '192.168.10.2'))
 
+    def test_recvfrom_into(self):
+        self.ds.deliver(b'test-into', '192.168.10.1')
+        self.ds.deliver(b'test-into-trunc', '192.168.10.2')
+        self.ds.deliver(b'test-into-nbytes', '192.168.10.3')
+        buf = bytearray(10)
+        self.assertEqual(self.ds.recvfrom_into(buf), (9, '192.168.10.1'))
+        self.assertEqual(buf[:9], b'test-into')
+        self.assertEqual(self.ds.recvfrom_into(buf), (10, '192.168.10.2'))
+        self.assertEqual(buf, b'test-into-')
+        self.assertEqual(self.ds.recvfrom_into(memoryview(buf)[2:], 4),
+                         (4, '192.168.10.3'))
+        self.assertEqual(buf, b'tetestnto-')
+
+    def test_recvfrom_into_small(self):
+        self.ds.deliver(b'test-kept', '192.168.10.1')
+        with self.assertRaises(ValueError):
+            self.ds.recvfrom_into(bytearray(4), 9)
+        self.assertEqual(self.ds.recvfrom(), (b'test-kept', '192.168.10.1'))
+
 class H_StreamSocketTest(unittest.TestCase):
     def setUp(self):
         self.p = mock.MagicMock(name='protocol', spec=Protocol)
@@ -282,5 +907,51 @@ class H_StreamSocketTest(unittest.TestCase):
         self.assertEqual(self.ss.recv(4), b"lo w")
         self.assertEqual(self.ss.recv(), b"orld")
 
+    def test_deliver_chunks(self):
+        for i in range(1000):
+            self.ss.deliver(b"%03d" % i)
+        self.assertEqual(self.ss.recv(5), b"00000")
+        self.assertEqual(self.ss.recv(2992), b"".join(b"%03d" % i
+                                                     for i in range(1000))[5:2997])
+        self.assertEqual(self.ss.recv(), b"999")
+
+    def test_recv_into(self):
+        self.ss.deliver(b"hello")
+        self.ss.deliver(b" world")
+        buf = bytearray(8)
+        self.assertEqual(self.ss.recv_into(buf), 8)
+        self.assertEqual(buf, b"hello wo")
+        self.assertEqual(self.ss.recv_into(memoryview(buf)[4:], 1), 1)
+        self.assertEqual(buf, b"hellr wo")
+        self.assertEqual(self.ss.readinto(buf), 2)
+        self.assertEqual(buf[:2], b"ld")
+
+    def test_recv_into_small(self):
+        self.ss.deliver(b"kept")
+        with mock.patch.object(self.ss, 'consumed') as consumed:
+            with self.assertRaises(ValueError):
+                self.ss.recv_into(bytearray(2), 4)
+            consumed.assert_not_called()
+        self.assertEqual(self.ss.recv(), b"kept")
+
+    def test_block(self):
+        timer = threading.Timer(0.05, self.ss.deliver, args=(b"late",))
+        timer.start()
+        self.assertEqual(self.ss.recv(), b"late")
+        timer.join()
+
+    def test_timeout(self):
+        with self.assertRaises(StreamSocket.Timeout):
+            self.ss.recv(timeout=0.01)
+        self.ss.deliver(b"ok")
+        self.assertEqual(self.ss.recv(timeout=0.01), b"ok")
+
+    def test_eof(self):
+        self.ss.deliver(b"last")
+        self.ss.deliver_eof()
+        self.assertEqual(self.ss.recv(), b"last")
+        self.assertEqual(self.ss.recv(), b"")
+        self.assertEqual(self.ss.recv_into(bytearray(4)), 0)
+
 if __name__ == '__main__':
     unittest.main()
@@ -21,12 +21,31 @@ class BaseNetworkTest(unittest.TestCase):
     # Provide defaults
     LOSS = 0.00
     PER = 0.00
+    MTU = None
+    QUEUED = False
+    DELAY = 0.0
+    JITTER = 0.0
+    REORDER = 0.0
+    VIRTUAL = False
+    # Bandwidth (bits per second) of each host, and a function returning the
+    # QueueDiscipline for its queue
+    BANDWIDTH = None
+    QUEUE = None
+    # Routers between the network of the first client's host and that of
+    # every other host, each network having the settings above; 0 puts every
+    # host on one
+    HOPS = 0
+    # Function returning a list of ChannelModels to use instead of LOSS and
+    # PER
+    CHANNEL = None
     # List of client socket addresses (bound if port is not None)
     CLIENTS = []
     # List of listening socket addresses (port must be set)
     LISTEN = []
     # Map of connection names to (client index, server index) pairs
     CONNS = {}
+    # Attributes to set on every listening and client socket
+    SOCKOPTS = {}
 
     def _connect_clients(self, conns, tick):
         for n, (c, l) in conns.items():
@@ -59,19 +78,25 @@ class BaseNetworkTest(unittest.TestCase):
             conns = type(self).CONNS
         pid = type(self).PROTO.getid()
 
-        # Create network and hosts
-        n = Network(loss=type(self).LOSS, per=type(self).PER)
+        # Create networks and hosts
+        clock = VirtualClock() if type(self).VIRTUAL else None
+        nets = [self.network(clock) for i in range(type(self).HOPS + 1)]
+        first = caddrs[0][0] if caddrs else None
         self.h = {}
         # Use set comprehension to eliminate duplicates
         for ip in {fst for fst, _ in itertools.chain(caddrs, laddrs)}:
-            h = Host(n, ip)
+            h = Host(nets[0] if ip == first else nets[-1], ip)
             h.register_protocol(type(self).PROTO)
             self.h[ip] = h
+        if type(self).HOPS:
+            self.route(nets)
 
         # Create and set up listening sockets
         self.lsocks = {}
         for ip, port in laddrs:
             ls = self.h[ip].socket(pid)
+            for opt, val in type(self).SOCKOPTS.items():
+                setattr(ls, opt, val)
             ls.bind(port)
             ls.listen()
             self.lsocks[ip, port] = ls
@@ -80,6 +105,8 @@ class BaseNetworkTest(unittest.TestCase):
         self.csocks = []
         for ip, port in caddrs:
             cs = self.h[ip].socket(pid)
+            for opt, val in type(self).SOCKOPTS.items():
+                setattr(cs, opt, val)
             if port:
                 cs.bind(port)
             self.csocks.append(cs)
@@ -90,6 +117,36 @@ class BaseNetworkTest(unittest.TestCase):
         self.c = {}
         self.makeconns(conns)
 
+    def network(self, clock):
+        return Network(loss=type(self).LOSS, per=type(self).PER,
+                       mtu=type(self).MTU, queued=type(self).QUEUED,
+                       delay=type(self).DELAY, jitter=type(self).JITTER,
+                       reorder=type(self).REORDER, clock=clock,
+                       channel=type(self).CHANNEL and type(self).CHANNEL(),
+                       bandwidth=type(self).BANDWIDTH,
+                       queue=type(self).QUEUE and type(self).QUEUE())
+
+    def route(self, nets):
+        """
+        Joins the networks in a line with routers, the one after network i
+        being 10.254.i.2 on it and 10.254.i+1.1 on the next
+        """
+        last = len(nets) - 1
+        for i in range(last):
+            r = Router(nets[i], '10.254.%d.2' % i)
+            r.add_interface(nets[i + 1], '10.254.%d.1' % (i + 1))
+            for ip, h in self.h.items():
+                if h.net is nets[0]:
+                    r.add_route(ip, None if i == 0 else '10.254.%d.1' % i,
+                                '10.254.%d.2' % i)
+                else:
+                    r.add_route(ip, None if i == last - 1
+                                else '10.254.%d.2' % (i + 1),
+                                '10.254.%d.1' % (i + 1))
+        for h in self.h.values():
+            h.add_route('0.0.0.0/0', '10.254.0.2' if h.net is nets[0]
+                        else '10.254.%d.1' % last)
+
     def test_00_connect(self):
         """Connection setup is successful"""
         pass
@@ -185,6 +242,101 @@ class A0_ErrorChecking(BaseNetworkTest):
                     self.assertEqual(host, type(self).CLIENTS[2][0])
                     self.assertEqual(port, 8383)
 
+    def test_13_backlog(self):
+        """Connections beyond the backlog wait until one is accepted"""
+        self.l['l'].listen(1)
+        self.c['a'].connect(type(self).LISTEN[0])
+        with ExThread(target=self.c['b'].connect, args=(type(self).LISTEN[0],)):
+            time.sleep(0.1)
+            self.assertFalse(self.c['b'].is_connected)
+            cs, (host, port) = self.l['l'].accept()
+            self.assertEqual(port, self.c['a'].bound_port)
+            cs, (host, port) = self.l['l'].accept()
+            self.assertEqual(port, self.c['b'].bound_port)
+
+    def test_14_nolistener(self):
+        """Connecting to a port with no listener times out"""
+        self.c['a'].max_rto = 0.005
+        with self.assertRaises(RDTSocket.ConnectionTimeout):
+            self.c['a'].connect((type(self).LISTEN[1][0], 5555))
+
+    def test_15_closelistener(self):
+        """Closing a listening socket frees its port for another socket"""
+        proto = self.l['l'].proto
+        self.l['l'].close()
+        self.assertNotIn(type(self).LISTEN[0][1], proto.listening_sockets)
+        self.c['d'].bind(type(self).LISTEN[0][1])
+
+    def test_16_churn(self):
+        """Closed connections leave nothing behind in the protocol tables"""
+        client = self.c['a'].proto
+        server = self.l['l'].proto
+        ports = set(client.ports_in_use)
+        for i in range(20):
+            cs = client.socket()
+            cs.connect(type(self).LISTEN[0])
+            ss, _ = self.l['l'].accept()
+            cs.send(b'test-churn')
+            self.assertEqual(ss.recv(), b'test-churn')
+            cs.close()
+            self.assertEqual(ss.recv(), b'')
+            ss.close()
+        deadline = time.monotonic() + 5
+        while client.connections and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(client.connections, {})
+        self.assertEqual(server.connections, {})
+        self.assertEqual(client.ports_in_use, ports)
+
+    def test_17_closeafterfailedsend(self):
+        """Closing after a send timed out reports the undelivered data"""
+        cs = self.c['a']
+        cs.max_rto = 0.005
+        cs.connect(type(self).LISTEN[0])
+        ss, _ = self.l['l'].accept()
+        cs.proto.host.net.set_link(type(self).CLIENTS[0][0],
+                                   type(self).LISTEN[0][0], loss=1.0)
+        with self.assertRaises(RDTSocket.ConnectionTimeout):
+            cs.send(b'test-lost' * 1000)
+        with self.assertRaises(RDTSocket.ConnectionTimeout):
+            cs.close()
+        self.assertNotIn(cs.bound_port, cs.proto.ports_in_use)
+
+    def _accept_closed(self):
+        with self.assertRaises(StreamSocket.NotListening):
+            self.l['l'].accept()
+
+    def test_18_closewhileaccepting(self):
+        """Closing a listening socket wakes threads waiting in accept"""
+        thr = ExThread(target=self._accept_closed)
+        with thr:
+            time.sleep(0.1)
+            self.l['l'].close()
+            thr.join(5)
+            self.assertFalse(thr.is_alive())
+
+    def test_19_failedsendreleasesbuffer(self):
+        """A send which timed out leaves the caller's buffer free to resize"""
+        cs = self.c['a']
+        cs.max_rto = 0.005
+        cs.connect(type(self).LISTEN[0])
+        ss, _ = self.l['l'].accept()
+        cs.proto.host.net.set_link(type(self).CLIENTS[0][0],
+                                   type(self).LISTEN[0][0], loss=1.0)
+        buf = bytearray(b'test-lost' * 1000)
+        try:
+            cs.send(buf)
+        except RDTSocket.ConnectionTimeout:
+            buf.clear()
+        else:
+            self.fail("send did not time out")
+        self.assertTrue(all(isinstance(payload, bytes)
+                            for seq, payload in cs.send_queue))
+        self.assertTrue(all(isinstance(entry[0], bytes)
+                            for entry in cs.unacked.values()))
+        with self.assertRaises(RDTSocket.ConnectionTimeout):
+            cs.close()
+
 class A1_Lossless_1x1(BaseNetworkTest):
     CLIENTS = [('192.168.10.1', None), ('192.168.10.2', None)]
     LISTEN = [('192.168.10.1', 26093), ('192.168.10.2', 2531)]
@@ -304,6 +456,111 @@ class A1_Lossless_1x1(BaseNetworkTest):
             ofs = count % MAX
             self.c['c'].send(data[ofs:ofs+b])
 
+    def test_08_bulk(self):
+        """A large send is split into segments and arrives intact"""
+        self.makeconns({'c': (0, 1)})
+        data = bytes(random.getrandbits(8) for i in range(2 ** 16))
+        for i in range(4):
+            self.c['c'].send(data)
+            self.assertEqual(self.s['c'].recv(), data,
+                             'iteration {}'.format(i))
+
+    def test_09_controlwords(self):
+        """Data that looks like a control message is still just data"""
+        self.makeconns({'c': (0, 1)})
+        for data in (b'SYN', b'ACK', b'FIN', b'SYNACK'):
+            self.c['c'].send(data)
+            self.assertEqual(self.s['c'].recv(), data)
+            self.s['c'].send(data)
+            self.assertEqual(self.c['c'].recv(), data)
+
+    def test_10_mss(self):
+        """Sends are cut into segments of at most the socket's MSS"""
+        self.makeconns({'c': (0, 1)})
+        self.c['c'].mss = 100
+        data = bytearray(random.getrandbits(8) for i in range(10000))
+        self.c['c'].send(data)
+        self.assertEqual(self.s['c'].recv(), data)
+        self.c['c'].send(memoryview(data)[1000:3000])
+        self.assertEqual(self.s['c'].recv(), data[1000:3000])
+
+    def test_11_coalesce(self):
+        """Buffered sends are coalesced and delivered once flushed"""
+        self.makeconns({'c': (0, 1)})
+        self.c['c'].nodelay = False
+        pieces = [str(i).encode() for i in range(2000)]
+        for piece in pieces:
+            self.c['c'].send(piece)
+        self.c['c'].flush()
+        self.assertEqual(self.s['c'].recv(), b''.join(pieces))
+
+    def test_12_buffered_stress(self):
+        """A lot of data can be sent through the send buffer"""
+        self.csocks[0].nodelay = False
+        self.test_07_stress()
+        self.c['c'].flush()
+
+    def test_13_flowcontrol(self):
+        """A slow reader holds no more than its receive buffer"""
+        self.lsocks[type(self).LISTEN[1]].rcvbuf = 4096
+        self.makeconns({'c': (0, 1)})
+        data = bytes(random.getrandbits(8) for i in range(2 ** 16))
+        received = bytearray()
+        with ExThread(target=self.c['c'].send, args=(data,)):
+            while len(received) < len(data):
+                time.sleep(0.0005)
+                self.assertLessEqual(self.s['c'].buffered +
+                                     len(self.s['c'].out_of_order), 4096)
+                received += self.s['c'].recv(1000)
+        self.assertEqual(received, data)
+
+    def wait_closed(self, *socks):
+        deadline = time.monotonic() + 5
+        while (not all(sock.closed for sock in socks) and
+               time.monotonic() < deadline):
+            time.sleep(0.01)
+        for sock in socks:
+            self.assertTrue(sock.closed)
+
+    def test_14_close(self):
+        """Closing ends the stream after the data and releases the port"""
+        self.makeconns({'c': (0, 1)})
+        client, server = self.c['c'], self.s['c']
+        port = client.bound_port
+        client.send(b'test-close')
+        client.close()
+        received = bytearray()
+        while True:
+            data = server.recv()
+            if not data:
+                break
+            received += data
+        self.assertEqual(received, b'test-close')
+        self.assertEqual(server.recv(), b'')
+        server.close()
+        self.wait_closed(client, server)
+        self.assertNotIn(port, client.proto.ports_in_use)
+        self.assertNotIn(client, client.proto.connections.values())
+        self.assertNotIn(server, server.proto.connections.values())
+        self.assertIn(server.bound_port, server.proto.ports_in_use)
+
+    def test_15_halfclose(self):
+        """Data still flows the other way after one side shuts down writing"""
+        self.makeconns({'c': (0, 1)})
+        client, server = self.c['c'], self.s['c']
+        client.shutdown(SHUT_WR)
+        self.assertEqual(server.recv(), b'')
+        with self.assertRaises(StreamSocket.NotConnected):
+            client.send(b'test-halfclose')
+        for i in range(10):
+            data = b'test-halfclose' + str(i).encode()
+            server.send(data)
+            self.assertEqual(client.recv(), data)
+        server.close()
+        self.assertEqual(client.recv(), b'')
+        client.close()
+        self.wait_closed(client, server)
+
 class A2_Lossless_SameHost(A1_Lossless_1x1):
     """Runs the Lossless 1x1 tests between two sockets on a single host"""
     CLIENTS = [('92.68.10.1', None), ('92.68.10.1', None)]
@@ -396,6 +653,76 @@ class A7_Lossless_ManyConns(BaseNetworkTest):
     LISTEN = [('192.168.40.253', 48000 + i) for i in range(10)]
     CONNS = {'{}->{}'.format(i, i % 10): (i, i % 10) for i in range(1000)}
 
+class A8_Lossless_GoBackN_1x1(A1_Lossless_1x1):
+    """Runs the Lossless 1x1 tests with a Go-Back-N sender and receiver"""
+    SOCKOPTS = {'mode': GO_BACK_N}
+
+class A9_Unreachable(BaseNetworkTest):
+    LOSS = 1.00
+    CLIENTS = [('192.168.60.1', None)]
+    LISTEN = [('192.168.60.2', 2468)]
+    CONNS = {'a': (0, None)}
+    SOCKOPTS = {'max_rto': 0.01}
+
+    def test_01_timeout(self):
+        """Unacknowledged data raises an error instead of vanishing"""
+        with self.assertRaises(RDTSocket.ConnectionTimeout):
+            self.c['a'].connect(type(self).LISTEN[0])
+            self.c['a'].send(b'test-timeout')
+
+class A10_Lossless_MTU576_1x1(A1_Lossless_1x1):
+    """Runs the Lossless 1x1 tests on a network with a small MTU"""
+    MTU = 576
+
+class A11_Lossless_DelayedAck_1x1(A1_Lossless_1x1):
+    """Runs the Lossless 1x1 tests with delayed acknowledgments"""
+    SOCKOPTS = {'ack_delay': 0.0002}
+
+class A12_Lossless_Cubic_1x1(A1_Lossless_1x1):
+    """Runs the Lossless 1x1 tests with CUBIC congestion control"""
+    SOCKOPTS = {'congestion': CubicCongestion}
+
+class A13_Lossless_Queued_1x1(A1_Lossless_1x1):
+    """Runs the Lossless 1x1 tests with each host input on its own thread"""
+    QUEUED = True
+
+class A14_Lossless_Queued_ManyConns(A7_Lossless_ManyConns):
+    QUEUED = True
+
+class A15_Lossless_Delay_1x1(A1_Lossless_1x1):
+    """Runs the Lossless 1x1 tests over links with delay and jitter"""
+    DELAY = 0.0005
+    JITTER = 0.0005
+
+class A16_Lossless_Virtual_1x1(A1_Lossless_1x1):
+    """
+    Runs the Lossless 1x1 tests in simulated time, over links whose delay
+    would make them slow in real time
+    """
+    VIRTUAL = True
+    DELAY = 0.02
+    JITTER = 0.01
+
+class A17_Lossless_Bottleneck_1x1(A16_Lossless_Virtual_1x1):
+    """
+    Runs the Lossless 1x1 tests in simulated time, through a 10 Mbit/s
+    bottleneck whose queue is large enough never to drop
+    """
+    BANDWIDTH = 10e6
+    @staticmethod
+    def QUEUE():
+        return DropTail(100000)
+
+class A18_Lossless_3Hop_1x1(A16_Lossless_Virtual_1x1):
+    """
+    Runs the Lossless 1x1 tests in simulated time, across three networks
+    joined by two routers
+    """
+    HOPS = 2
+
+class A19_Lossless_3Hop_1x2(A3_Lossless_1x2):
+    HOPS = 2
+
 class B1_Corrupt02_1x1(A1_Lossless_1x1):
     PER = 0.02
 class B2_Corrupt02_SameHost(A2_Lossless_SameHost):
@@ -441,6 +768,11 @@ class D6_Corrupt10_2x1_SameHost(A6_Lossless_2x1_SameHost):
 class D7_Corrupt10_ManyConns(A7_Lossless_ManyConns):
     PER = 0.10
 
+class InternetChecksumRDTProtocol(RDTProtocol):
+    CHECKSUM = InternetChecksum
+class D8_Corrupt10_InternetChecksum_1x1(D1_Corrupt10_1x1):
+    PROTO = InternetChecksumRDTProtocol
+
 class E1_Lose02_1x1(A1_Lossless_1x1):
     LOSS = 0.02
 class E2_Lose02_SameHost(A2_Lossless_SameHost):
@@ -471,6 +803,9 @@ class F6_Lose05_2x1_SameHost(A6_Lossless_2x1_SameHost):
 class F7_Lose05_ManyConns(A7_Lossless_ManyConns):
     LOSS = 0.05
 
+class F11_Lose05_DelayedAck_1x1(A11_Lossless_DelayedAck_1x1):
+    LOSS = 0.05
+
 class G1_Lose10_1x1(A1_Lossless_1x1):
     LOSS = 0.10
 class G2_Lose10_SameHost(A2_Lossless_SameHost):
@@ -486,6 +821,55 @@ class G6_Lose10_2x1_SameHost(A6_Lossless_2x1_SameHost):
 class G7_Lose10_ManyConns(A7_Lossless_ManyConns):
     LOSS = 0.10
 
+class G8_Lose10_GoBackN_1x1(A8_Lossless_GoBackN_1x1):
+    LOSS = 0.10
+
+class G9_Lose10_Cubic_1x1(A12_Lossless_Cubic_1x1):
+    LOSS = 0.10
+
+class G10_Lose10_Queued_1x1(A13_Lossless_Queued_1x1):
+    LOSS = 0.10
+
+class G11_Lose10_Reorder_1x1(A15_Lossless_Delay_1x1):
+    LOSS = 0.10
+    REORDER = 0.10
+
+class G12_Lose10_Virtual_1x1(A16_Lossless_Virtual_1x1):
+    LOSS = 0.10
+
+class G13_BurstLoss_1x1(A1_Lossless_1x1):
+    """Runs the 1x1 tests with loss in bursts and scattered bit errors"""
+    @staticmethod
+    def CHANNEL():
+        # The model moves on only as packets cross it, so a burst catches
+        # every retransmission of a segment sent alone; bursts must be short
+        # enough that RETRIES of them in a row cannot happen in practice
+        return [GilbertElliott(0.02, 0.5), BitErrors(2e-6), Truncation(0.01)]
+
+class G14_DropTail_1x1(A17_Lossless_Bottleneck_1x1):
+    """Runs the 1x1 tests with losses only where the sender's queue fills"""
+    @staticmethod
+    def QUEUE():
+        return DropTail(5)
+
+class G15_CoDel_1x1(A17_Lossless_Bottleneck_1x1):
+    """Runs the 1x1 tests through a slower bottleneck managed by CoDel"""
+    BANDWIDTH = 1e6
+    @staticmethod
+    def QUEUE():
+        return CoDel()
+
+class G16_Lose05_3Hop_1x1(A18_Lossless_3Hop_1x1):
+    """Runs the 1x1 tests losing 5% of packets on each of three networks"""
+    LOSS = 0.05
+
+class G17_Corrupt05Lose05_3Hop_1x1(G16_Lose05_3Hop_1x1):
+    """
+    Runs the 1x1 tests with corruption and loss on each of three networks,
+    so that routers forward packets corrupted on an earlier hop
+    """
+    PER = 0.05
+
 class H1_Corrupt10Lose10_1x1(A1_Lossless_1x1):
     LOSS = 0.10
     PER = 0.10
@@ -508,5 +892,325 @@ class H7_Corrupt10Lose10_ManyConns(A7_Lossless_ManyConns):
     LOSS = 0.10
     PER = 0.10
 
+class I_SequenceNumbers(unittest.TestCase):
+    def test_unwrap(self):
+        """Wire sequence numbers are recovered across 32-bit wraparound"""
+        self.assertEqual(unwrap(1000, 0), 1000)
+        self.assertEqual(unwrap(1000, 5000), 1000)
+        self.assertEqual(unwrap(10, SEQ_MOD - 10), SEQ_MOD + 10)
+        self.assertEqual(unwrap(SEQ_MOD - 10, SEQ_MOD + 10), SEQ_MOD - 10)
+        self.assertEqual(unwrap(5, 3 * SEQ_MOD), 3 * SEQ_MOD + 5)
+
+class J_Checksums(unittest.TestCase):
+    ALGORITHMS = (SumChecksum, InternetChecksum, CRC32Checksum)
+
+    def test_known(self):
+        """Checksums match published test vectors"""
+        # RFC 1071 section 3 example
+        self.assertEqual(InternetChecksum().compute(
+            bytes.fromhex('0001f203f4f5f6f7')), bytes.fromhex('220d'))
+        self.assertEqual(CRC32Checksum().compute(b'123456789'),
+                         bytes.fromhex('cbf43926'))
+
+    def test_parts(self):
+        """Checksum of parts equals checksum of their concatenation"""
+        data = bytes(random.getrandbits(8) for i in range(101))
+        for cls in type(self).ALGORITHMS:
+            cs = cls()
+            for cut in (0, 1, 16, 17, 100, 101):
+                self.assertEqual(cs.compute(data[:cut], data[cut:]),
+                                 cs.compute(data), cls.__name__)
+
+    def test_single_byte(self):
+        """Every single-byte error is detected"""
+        data = bytes(random.getrandbits(8) for i in range(64))
+        for cls in type(self).ALGORITHMS:
+            cs = cls()
+            seg = bytearray(cs.seal(data))
+            self.assertTrue(cs.verify(seg))
+            for pos in range(len(seg)):
+                orig = seg[pos]
+                seg[pos] = (orig + random.randint(1, 255)) % 256
+                self.assertFalse(cs.verify(seg), cls.__name__)
+                seg[pos] = orig
+
+    def test_reorder(self):
+        """CRC-32 detects swapped words, which the sums cannot"""
+        data = b'ab' + b'cd' + bytes(60)
+        swapped = b'cd' + b'ab' + bytes(60)
+        self.assertEqual(InternetChecksum().compute(data),
+                         InternetChecksum().compute(swapped))
+        self.assertNotEqual(CRC32Checksum().compute(data),
+                            CRC32Checksum().compute(swapped))
+
+class K_RTTEstimator(unittest.TestCase):
+    def test_initial(self):
+        """Initial timeout is used until a sample arrives"""
+        rtt = RTTEstimator(0.5, 0.001, 2.0)
+        self.assertEqual(rtt.rto, 0.5)
+
+    def test_samples(self):
+        """Timeout follows the smoothed RTT and its variation"""
+        rtt = RTTEstimator(1.0, 0.001, 60.0)
+        rtt.sample(0.1)
+        self.assertAlmostEqual(rtt.srtt, 0.1)
+        self.assertAlmostEqual(rtt.rto, 0.1 + 4 * 0.05)
+        for i in range(100):
+            rtt.sample(0.1)
+        self.assertAlmostEqual(rtt.srtt, 0.1)
+        self.assertLess(rtt.rto, 0.11)
+
+    def test_bounds(self):
+        """Timeout stays between the configured bounds"""
+        rtt = RTTEstimator(1.0, 0.2, 3.0)
+        rtt.sample(0.001)
+        self.assertEqual(rtt.rto, 0.2)
+        rtt.sample(10.0)
+        self.assertEqual(rtt.rto, 3.0)
+
+    def test_backoff(self):
+        """Each expiry doubles the timeout up to the maximum"""
+        rtt = RTTEstimator(0.1, 0.001, 0.5)
+        rtt.backoff()
+        self.assertAlmostEqual(rtt.rto, 0.2)
+        rtt.backoff()
+        rtt.backoff()
+        self.assertEqual(rtt.rto, 0.5)
+
+    def test_clear_backoff(self):
+        """Clearing the backoff restores the estimated timeout"""
+        rtt = RTTEstimator(0.1, 0.001, 5.0)
+        rtt.backoff()
+        rtt.clear_backoff()
+        self.assertAlmostEqual(rtt.rto, 0.2)
+        rtt.sample(0.1)
+        rtt.backoff()
+        rtt.backoff()
+        rtt.clear_backoff()
+        self.assertAlmostEqual(rtt.rto, 0.3)
+
+class L_EphemeralPorts(unittest.TestCase):
+    class SmallRangeRDTProtocol(RDTProtocol):
+        EPHEMERAL_PORTS = range(5000, 5004)
+
+    def setUp(self):
+        h = Host(Network(), '10.70.0.1')
+        h.register_protocol(self.SmallRangeRDTProtocol)
+        self.proto = h.protos[self.SmallRangeRDTProtocol.getid()]
+
+    def test_rotation(self):
+        """Released ports are reused only after the rest of the range"""
+        self.assertEqual(self.proto.allocate_port(), 5000)
+        self.assertEqual(self.proto.allocate_port(), 5001)
+        self.proto.release_port(5000)
+        self.assertEqual(self.proto.allocate_port(), 5002)
+        self.assertEqual(self.proto.allocate_port(), 5003)
+        self.assertEqual(self.proto.allocate_port(), 5000)
+
+    def test_bound(self):
+        """Explicitly bound ports are skipped"""
+        self.proto.socket().bind(5000)
+        self.proto.socket().bind(5002)
+        self.assertEqual(self.proto.allocate_port(), 5001)
+        self.assertEqual(self.proto.allocate_port(), 5003)
+        with self.assertRaises(Socket.AddressInUse):
+            self.proto.allocate_port()
+        self.proto.release_port(5002)
+        self.assertEqual(self.proto.allocate_port(), 5002)
+
+    def test_lazy(self):
+        """Ports are tracked only once they have been used"""
+        h = Host(Network(), '10.70.0.2')
+        h.register_protocol(RDTProtocol)
+        proto = h.protos[RDTProtocol.getid()]
+        first = RDTProtocol.EPHEMERAL_PORTS[0]
+        for i in range(1000):
+            port = proto.allocate_port()
+            self.assertEqual(port, first + i)
+            proto.release_port(port)
+        self.assertEqual(len(proto.ports_in_use), 0)
+        self.assertEqual(len(proto.released), 1000)
+        proto.socket().bind(first)
+        for port in RDTProtocol.EPHEMERAL_PORTS[1000:]:
+            self.assertEqual(proto.allocate_port(), port)
+        self.assertEqual(proto.allocate_port(), first + 1)
+
+    def _sock(self, port, remote=None):
+        s = self.proto.socket()
+        s.bound_port = port
+        s.is_listening = remote is None
+        if remote is not None:
+            s.remote_IP, s.remote_port = remote
+        self.proto.register(s)
+        return s
+
+    def test_shared_port(self):
+        """A port is released when its last listener or connection goes"""
+        self.proto.claim_port(80)
+        listener = self._sock(80)
+        conns = [self._sock(80, ('10.70.0.%d' % i, 1234)) for i in range(3)]
+        self.assertEqual(self.proto.port_users[80], 4)
+        self.proto.unregister(listener)
+        self.proto.unregister(conns[0])
+        self.assertIn(80, self.proto.ports_in_use)
+        self.proto.unregister(conns[0])
+        self.proto.unregister(conns[1])
+        self.proto.unregister(conns[2])
+        self.assertNotIn(80, self.proto.ports_in_use)
+        self.assertEqual(self.proto.port_users, {})
+
+    def test_concurrent_close(self):
+        """Connections come and go on one thread while another closes"""
+        self.proto.claim_port(80)
+        self._sock(80)
+        stop = threading.Event()
+        def churn():
+            for i in itertools.count():
+                if stop.is_set():
+                    return
+                self.proto.unregister(self._sock(80, ('10.70.1.1', i)))
+        with ExThread(target=churn):
+            try:
+                for i in range(20000):
+                    self.proto.unregister(self._sock(80, ('10.70.2.1', i)))
+            finally:
+                stop.set()
+        self.assertEqual(self.proto.port_users[80], 1)
+
+    def test_connect(self):
+        """Connect binds an unbound socket to an ephemeral port"""
+        s = self.proto.socket()
+        s.max_rto = 0.005
+        with self.assertRaises(RDTSocket.ConnectionTimeout):
+            s.connect(('10.70.0.2', 80))
+        self.assertIn(s.bound_port, self.SmallRangeRDTProtocol.EPHEMERAL_PORTS)
+        with self.assertRaises(Socket.AddressInUse):
+            self.proto.socket().bind(s.bound_port)
+
+class M_ReassemblyBuffer(unittest.TestCase):
+    def test_merge(self):
+        """Adjacent and overlapping segments merge into one range"""
+        buf = ReassemblyBuffer()
+        buf.add(20, b'cc')
+        buf.add(10, b'aaaaa')
+        self.assertEqual(buf.starts, [10, 20])
+        buf.add(15, b'bbbbb')
+        self.assertEqual(buf.starts, [10])
+        buf.add(18, b'xxxxxxx')
+        self.assertEqual(buf.starts, [10])
+        self.assertEqual(len(buf), 15)
+        self.assertEqual(bytes(buf.pop(10)), b'aaaaabbbbbccxxx')
+        self.assertEqual(len(buf), 0)
+
+    def test_gap(self):
+        """Nothing is released across a gap"""
+        buf = ReassemblyBuffer()
+        buf.add(10, b'later')
+        self.assertIsNone(buf.pop(5))
+        buf.add(5, b'early')
+        self.assertEqual(bytes(buf.pop(5)), b'earlylater')
+
+    def test_trim(self):
+        """Data before the requested sequence number is discarded"""
+        buf = ReassemblyBuffer()
+        buf.add(0, b'old')
+        buf.add(5, b'0123456789')
+        self.assertEqual(bytes(buf.pop(8)), b'3456789')
+        self.assertIsNone(buf.pop(15))
+
+    def test_blocks(self):
+        """Ranges are reported with the most recent one first"""
+        buf = ReassemblyBuffer()
+        buf.add(10, b'aa')
+        buf.add(20, b'bb')
+        buf.add(30, b'cc')
+        self.assertEqual(buf.blocks(), [(10, 12), (20, 22), (30, 32)])
+        self.assertEqual(buf.blocks(21), [(20, 22), (10, 12), (30, 32)])
+
+class N_Scoreboard(unittest.TestCase):
+    def setUp(self):
+        h = Host(Network(), '10.80.0.1')
+        h.register_protocol(RDTProtocol)
+        self.sock = h.socket(RDTProtocol.getid())
+        self.sock.rtt = RTTEstimator(1.0, 1.0, 60.0)
+        self.sock.cc = RenoCongestion()
+        self.sock.snd_wnd = 65536
+        now = time.monotonic()
+        for i in range(8):
+            self.sock.unacked[i * 100] = [bytes(100), now + i * 0.001, 0, 0]
+
+    def test_sack(self):
+        """Selectively acknowledged segments leave the scoreboard"""
+        self.sock.acknowledge(200, 65536, [(300, 500), (600, 700)])
+        self.assertEqual(list(self.sock.unacked), [200, 500, 700])
+        self.assertEqual(self.sock.snd_una, 200)
+
+    def test_lost(self):
+        """A hole is retransmitted once later segments are SACKed"""
+        for end in range(200, 200 + 100 * RDTSocket.DUPTHRESH, 100):
+            self.assertEqual(self.sock.lost, [])
+            self.sock.acknowledge(0, 65536, [(100, end)])
+        self.assertEqual(self.sock.lost, [0])
+        rto = self.sock.rtt.rto
+        due = self.sock.due_segments()
+        self.assertEqual([seq for seq, payload in due], [0])
+        self.assertEqual(self.sock.rtt.rto, rto)
+        self.assertEqual(self.sock.timeouts, 0)
+        self.assertLess(self.sock.cc.cwnd, RenoCongestion.INITIAL_WINDOW)
+
+    def test_timeout(self):
+        """A timeout resends no more than the congestion window allows"""
+        for entry in self.sock.unacked.values():
+            entry[1] -= 2
+        due = self.sock.due_segments()
+        self.assertLessEqual(len(due), self.sock.cc.cwnd)
+        self.assertEqual([seq for seq, payload in due], [0])
+        self.assertEqual(self.sock.timeouts, 1)
+        # the rest go out as acknowledgments open the window
+        self.sock.acknowledge(100, 65536, [])
+        due = self.sock.due_segments()
+        self.assertEqual([seq for seq, payload in due],
+                         list(range(100, 100 + 100 * int(self.sock.cc.cwnd),
+                                    100)))
+        # and nothing is left to resend once everything is acknowledged
+        self.sock.acknowledge(800, 65536, [])
+        self.assertEqual(self.sock.due_segments(), [])
+
+    def test_repeated_timeout(self):
+        """Each further timeout on a dead path resends a single segment"""
+        for i in range(3):
+            for entry in self.sock.unacked.values():
+                entry[1] -= 1000
+            self.assertEqual(len(self.sock.due_segments()), 1)
+
+class O_CongestionControl(unittest.TestCase):
+    def test_reno(self):
+        """Reno grows exponentially, then linearly, and halves on loss"""
+        cc = RenoCongestion()
+        cc.on_ack(10, 0.0)
+        self.assertEqual(cc.cwnd, 20)
+        cc.on_loss(0.0)
+        self.assertEqual((cc.cwnd, cc.ssthresh), (10, 10))
+        cc.on_ack(10, 0.0)
+        self.assertAlmostEqual(cc.cwnd, 11)
+        cc.on_timeout(0.0)
+        self.assertEqual((cc.cwnd, cc.ssthresh), (1, 5.5))
+
+    def test_cubic(self):
+        """CUBIC cuts by BETA and regrows to the previous maximum"""
+        cc = CubicCongestion()
+        cc.on_ack(90, 0.0)
+        cc.on_loss(0.0)
+        self.assertAlmostEqual(cc.cwnd, 100 * CubicCongestion.BETA)
+        self.assertEqual(cc.w_max, 100)
+        cc.on_ack(1, 0.0)
+        for i in range(1, 1001):
+            cc.on_ack(1, cc.k * i / 1000)
+        self.assertGreater(cc.cwnd, 95)
+        self.assertLess(cc.cwnd, 101)
+        # fast convergence: a loss short of the old maximum lowers it
+        cc.on_loss(1.0)
+        self.assertLess(cc.w_max, 100)
+
 if __name__ == '__main__':
     unittest.main()